@@ -10,9 +10,14 @@ Library to aggregate quantitative data.
 """
 
 import math
+import numpy as np
 import pandas as pd
 from scipy.stats import zscore
 
+# standard deviations this close (relative) are a tie : the
+# running and the two-pass deviations differ by rounding only
+stdTieTolerance = 1e-12
+
 def getDataFrameRowByStd(dataFrame, ascend):
     """
     Return a dataframe row depending on its standard
@@ -27,9 +32,10 @@ def getDataFrameRowByStd(dataFrame, ascend):
     -------
     pandas.DataFrame
     """
-    # Prevent error message if empty dataframe
-    selectedRow = dataFrame.std(axis = 1).sort_values(ascending = ascend).index[0]
-    return dataFrame.loc[selectedRow]
+    values = dataFrame.to_numpy(dtype = 'float64')
+    selectedRow = getSegmentStdRowIndex(values, [0, len(values)], ascend)[0]
+    # raises IndexError if empty dataframe
+    return dataFrame.iloc[selectedRow]
 
 def getDataFrameMinStdRow(dataFrame):
     """
@@ -110,7 +116,9 @@ def getDataFrameUpDownZAggregate(dataFrame):
     -------
     pandas.DataFrame
     """
-    return dataFrame.apply(lambda col: getUpDownZScore(*countPosAndNeg(col)))
+    values = dataFrame.to_numpy(dtype = 'float64')
+    zScores = getSegmentUpDownZAggregate(values, [0, len(values)])[0]
+    return pd.Series(zScores, index = dataFrame.columns)
 
 def getDataFrameMeanAggregate(dataFrame):
     """
@@ -140,7 +148,10 @@ def getDataFrameNormalZAggregate(dataFrame):
     -------
     Series or DataFrame (if level specified)
     """
-    return getDataFrameMeanAggregate(zscore(dataFrame, axis = 1))
+    # zscore() returns an array : keep the columns to average them
+    zScores = pd.DataFrame(zscore(dataFrame, axis = 1),
+                           index = dataFrame.index, columns = dataFrame.columns)
+    return getDataFrameMeanAggregate(zScores)
 
 def getDataFrameAggregate(dataFrame, method):
     """
@@ -161,3 +172,559 @@ def getDataFrameAggregate(dataFrame, method):
         'upDownZ': getDataFrameUpDownZAggregate
     }
     return algorithms[method](dataFrame)
+
+def getMatrixRowStd(matrix):
+    """
+    Return the standard deviation of each row of a matrix,
+    ignoring NaN, as pandas.DataFrame.std(axis = 1). Rows
+    with less than 2 values get NaN.
+
+    Parameters
+    ----------
+    matrix : numpy array
+
+    Returns
+    -------
+    numpy array
+    """
+    isMeasured = ~np.isnan(matrix)
+    count = isMeasured.sum(axis = 1)
+    values = np.where(isMeasured, matrix, 0).astype('float64')
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = values.sum(axis = 1) / count
+        squares = np.where(isMeasured, values - mean[:, None], 0) ** 2
+        std = np.sqrt(squares.sum(axis = 1) / (count - 1))
+    std[count < 2] = np.nan
+    return std
+
+def getMatrixRowZScores(matrix):
+    """
+    Apply Z-score normalisation to each row of a matrix, as
+    zscore(matrix, axis = 1) : rows with a NaN or a null
+    standard deviation get NaN.
+
+    Parameters
+    ----------
+    matrix : numpy array
+
+    Returns
+    -------
+    numpy array
+    """
+    mean = matrix.mean(axis = 1, keepdims = True)
+    std = matrix.std(axis = 1, keepdims = True)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return (matrix - mean) / std
+
+def getSegmentSums(values, offsets, dtype = 'float64'):
+    """
+    Return the sum of the rows of each segment.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x timestamps, the members of a segment
+        being consecutive
+    offsets : numpy array
+        the first member of each segment, followed by the
+        number of members
+    dtype : str
+        the type of the sums
+
+    Returns
+    -------
+    numpy array
+        segments x timestamps, 0 for empty segments
+    """
+    offsets = np.asarray(offsets)
+    nonEmpty = np.diff(offsets) > 0
+    sums = np.zeros((len(offsets) - 1, values.shape[1]), dtype = dtype)
+    # the empty segments do not split the others
+    if nonEmpty.any():
+        sums[nonEmpty] = np.add.reduceat(values, offsets[:-1][nonEmpty],
+                                         axis = 0, dtype = dtype)
+    return sums
+
+def getSegmentMeanAggregate(values, offsets):
+    """
+    Return the average of the rows of each segment,
+    ignoring NaN.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x timestamps
+    offsets : numpy array
+
+    Returns
+    -------
+    numpy array
+        segments x timestamps
+    """
+    isMeasured = ~np.isnan(values)
+    sums = getSegmentSums(np.where(isMeasured, values, 0), offsets)
+    counts = getSegmentSums(isMeasured, offsets)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return sums / counts
+
+def getSegmentUpDownZAggregate(values, offsets):
+    """
+    Compute for each segment the Z-score of each column such as :
+    z = (nUp - nDown) / sqrt(nUp + nDown)
+    Where nUp and nDown are the numbers of rows of the segment
+    strictly positives and negatives in the column. NaN when
+    no row of the segment was measured in the column.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x timestamps
+    offsets : numpy array
+
+    Returns
+    -------
+    numpy array
+        segments x timestamps
+    """
+    nUp = getSegmentSums(values > 0, offsets)
+    nDown = getSegmentSums(values < 0, offsets)
+    nMeasured = getSegmentSums(~np.isnan(values), offsets)
+    zScores = (nUp - nDown) / np.sqrt(np.maximum(1, nUp + nDown))
+    zScores[nMeasured == 0] = np.nan
+    return zScores
+
+def getSegmentFirstMinIndex(keys, offsets, tolerance = 0):
+    """
+    Return for each segment its first member reaching the
+    minimum key of the segment.
+
+    Parameters
+    ----------
+    keys : numpy array
+        one key per member, inf for the members to select last
+    offsets : numpy array
+    tolerance : float
+        the keys within this relative distance of the minimum
+        reach it
+
+    Returns
+    -------
+    numpy array
+        the selected member of each segment, -1 if empty
+    """
+    offsets = np.asarray(offsets)
+    sizes = np.diff(offsets)
+    segments = np.repeat(np.arange(len(sizes)), sizes)
+    nonEmpty = sizes > 0
+    segmentMin = np.full(len(sizes), np.inf)
+    if nonEmpty.any():
+        segmentMin[nonEmpty] = np.minimum.reduceat(keys, offsets[:-1][nonEmpty])
+    threshold = segmentMin + tolerance * np.abs(segmentMin)
+    threshold[np.isinf(segmentMin)] = np.inf
+    candidates = np.flatnonzero(keys <= threshold[segments])
+    selectedSegments, first = np.unique(segments[candidates], return_index = True)
+    index = np.full(len(sizes), -1)
+    index[selectedSegments] = candidates[first]
+    return index
+
+def getStdKeys(std, ascend):
+    """
+    Return the keys selecting the smallest (ascend) or largest
+    standard deviation, NaN coming last.
+
+    Parameters
+    ----------
+    std : numpy array
+    ascend : Boolean
+
+    Returns
+    -------
+    numpy array
+    """
+    return np.where(np.isnan(std), np.inf, std if ascend else -std)
+
+def getSegmentStdRowIndex(values, offsets, ascend):
+    """
+    Return for each segment the member with the smallest
+    (ascend) or largest standard deviation, the first one in
+    case of a tie (see stdTieTolerance). Members without a
+    standard deviation come last.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x timestamps
+    offsets : numpy array
+    ascend : Boolean
+
+    Returns
+    -------
+    numpy array
+        the selected member of each segment, -1 if empty
+    """
+    return getSegmentFirstMinIndex(getStdKeys(getMatrixRowStd(values), ascend), offsets,
+                                   stdTieTolerance)
+
+def getSegmentRowByStd(values, offsets, ascend):
+    """
+    Return for each segment the row with the smallest
+    (ascend) or largest standard deviation.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x timestamps
+    offsets : numpy array
+    ascend : Boolean
+
+    Returns
+    -------
+    numpy array
+        segments x timestamps, NaN for empty segments
+    """
+    return getSelectedRows(values, getSegmentStdRowIndex(values, offsets, ascend))
+
+def getSelectedRows(values, index):
+    """
+    Return the selected row of each segment.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x timestamps
+    index : numpy array
+        the selected member of each segment, -1 if empty
+
+    Returns
+    -------
+    numpy array
+        segments x timestamps, NaN for empty segments
+    """
+    result = np.full((len(index), values.shape[1]), np.nan, dtype = values.dtype)
+    result[index >= 0] = values[index[index >= 0]]
+    return result
+
+def getSegmentMinStdRow(values, offsets):
+    """
+    Return for each segment the row with smallest standard deviation.
+
+    Parameters
+    ----------
+    values : numpy array
+    offsets : numpy array
+
+    Returns
+    -------
+    numpy array
+    """
+    return getSegmentRowByStd(values, offsets, True)
+
+def getSegmentMaxStdRow(values, offsets):
+    """
+    Return for each segment the row with largest standard deviation.
+
+    Parameters
+    ----------
+    values : numpy array
+    offsets : numpy array
+
+    Returns
+    -------
+    numpy array
+    """
+    return getSegmentRowByStd(values, offsets, False)
+
+def getSegmentNormalZAggregate(values, offsets):
+    """
+    Apply Z-score normalisation to each row, then average
+    the normalised rows of each segment.
+
+    Parameters
+    ----------
+    values : numpy array
+    offsets : numpy array
+
+    Returns
+    -------
+    numpy array
+    """
+    return getSegmentMeanAggregate(getMatrixRowZScores(values), offsets)
+
+def getSegmentAggregate(values, offsets, method):
+    """
+    Aggregate the rows of all segments at once.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x timestamps, the members of a segment
+        being consecutive
+    offsets : numpy array
+        the first member of each segment, followed by the
+        number of members
+    method : str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+
+    Returns
+    -------
+    numpy array
+        segments x timestamps
+    """
+    algorithms = {
+        'mean': getSegmentMeanAggregate,
+        'minStd': getSegmentMinStdRow,
+        'maxStd': getSegmentMaxStdRow,
+        'upDownZ': getSegmentUpDownZAggregate,
+        'normalZ': getSegmentNormalZAggregate
+    }
+    return algorithms[method](values, offsets)
+
+def getSparseAggregate(incidence, matrix, method):
+    """
+    Aggregate the matrix rows of all groups at once, with the
+    same methods as getDataFrameAggregate().
+
+    Parameters
+    ----------
+    incidence : scipy.sparse.csr_matrix
+        groups x rows incidence matrix, the rows of a group
+        being in their original order
+    matrix : numpy array
+        rows x timestamps
+    method : str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+
+    Returns
+    -------
+    numpy array
+        groups x timestamps
+    """
+    return getSegmentAggregate(matrix[incidence.indices], incidence.indptr, method)
+
+def getSubSegments(offsets, segments):
+    """
+    Return the members of some segments, with their offsets.
+
+    Parameters
+    ----------
+    offsets : numpy array
+    segments : numpy array
+        the selected segments
+
+    Returns
+    -------
+    members : numpy array
+    subOffsets : numpy array
+        the offsets of the selected segments among members
+    """
+    sizes = np.diff(offsets)[segments]
+    subOffsets = np.concatenate([[0], np.cumsum(sizes)])
+    members = np.repeat(offsets[segments] - subOffsets[:-1], sizes) + np.arange(subOffsets[-1])
+    return members, subOffsets
+
+class ColumnBuffer:
+    """
+    A matrix growing by columns. A spare capacity is kept so
+    that the earlier columns are not copied at each append.
+
+    Parameters
+    ----------
+    nRows : int
+    dtype : str
+    """
+
+    def __init__(self, nRows, dtype = 'float64'):
+        self.data = np.empty((nRows, 16), dtype = dtype)
+        self.nColumns = 0
+
+    @property
+    def values(self):
+        """
+        The filled columns, a view of the buffer.
+        """
+        return self.data[:, :self.nColumns]
+
+    def append(self, columns):
+        """
+        Append columns to the matrix.
+
+        Parameters
+        ----------
+        columns : numpy array
+            one row per matrix row
+        """
+        nColumns = self.nColumns + columns.shape[1]
+        if nColumns > self.data.shape[1]:
+            data = np.empty((self.data.shape[0], max(nColumns, 2 * self.data.shape[1])),
+                            dtype = self.data.dtype)
+            data[:, :self.nColumns] = self.values
+            self.data = data
+        self.data[:, self.nColumns:nColumns] = columns
+        self.nColumns = nColumns
+
+class SegmentAggregator:
+    """
+    Aggregate segments of rows whose timestamps arrive over
+    time, with the same results as getSegmentAggregate() on all
+    the timestamps. The running mean and variance of each
+    member (Welford) are kept so that an append only
+    aggregates the new columns. A segment is aggregated again
+    when its min/max-std row changes, and all of them with
+    normalZ, whose Z-scores depend on every timestamp.
+
+    Parameters
+    ----------
+    offsets : numpy array
+        the first member of each segment, followed by the
+        number of members
+    method : str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    """
+
+    def __init__(self, offsets, method):
+        self.offsets = np.asarray(offsets)
+        self.method = method
+        nMembers = self.offsets[-1]
+        self.nSegments = len(self.offsets) - 1
+        self.segments = np.repeat(np.arange(self.nSegments), np.diff(self.offsets))
+        self.members = ColumnBuffer(nMembers)
+        self.result = ColumnBuffer(self.nSegments)
+        self.count = np.zeros(nMembers)
+        self.mean = np.zeros(nMembers)
+        self.m2 = np.zeros(nMembers)
+        self.selected = np.full(self.nSegments, -1)
+
+    def updateStats(self, members, values):
+        """
+        Add timestamps to the running statistics of members,
+        ignoring NaN.
+
+        Parameters
+        ----------
+        members : numpy array
+        values : numpy array
+            members x new timestamps
+        """
+        isMeasured = ~np.isnan(values)
+        nNew = isMeasured.sum(axis = 1)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            newMean = np.where(isMeasured, values, 0).sum(axis = 1) / nNew
+            newM2 = (np.where(isMeasured, values - newMean[:, None], 0) ** 2).sum(axis = 1)
+            # merge the two sets of values (Chan et al.)
+            count = self.count[members]
+            total = count + nNew
+            delta = newMean - self.mean[members]
+            mean = self.mean[members] + delta * nNew / total
+            m2 = self.m2[members] + newM2 + delta ** 2 * count * nNew / total
+        hasNew = nNew > 0
+        self.mean[members] = np.where(hasNew, mean, self.mean[members])
+        self.m2[members] = np.where(hasNew, m2, self.m2[members])
+        self.count[members] = total
+
+    def getStd(self):
+        """
+        Return the standard deviation of each member, as
+        getMatrixRowStd().
+
+        Returns
+        -------
+        numpy array
+        """
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            std = np.sqrt(self.m2 / (self.count - 1))
+        std[self.count < 2] = np.nan
+        return std
+
+    def aggregateSegments(self, segments):
+        """
+        Aggregate again all the timestamps of some segments.
+
+        Parameters
+        ----------
+        segments : numpy array
+        """
+        if self.method == 'normalZ':
+            # the batch kernel : a Z-score of 0 must stay exactly 0
+            # for the strict signs counted by upDownZ
+            self.result.values[:] = getSegmentNormalZAggregate(self.members.values,
+                                                               self.offsets)
+        elif self.method in ['minStd', 'maxStd']:
+            self.result.values[segments] = getSelectedRows(self.members.values,
+                                                           self.selected[segments])
+        else:
+            members, subOffsets = getSubSegments(self.offsets, segments)
+            self.result.values[segments] = getSegmentAggregate(self.members.values[members],
+                                                               subOffsets, self.method)
+
+    def select(self):
+        """
+        Select again the min/max-std member of each segment.
+
+        Returns
+        -------
+        changed : numpy array
+            True for the segments with another member
+        """
+        keys = getStdKeys(self.getStd(), self.method == 'minStd')
+        selected = getSegmentFirstMinIndex(keys, self.offsets, stdTieTolerance)
+        changed = selected != self.selected
+        self.selected = selected
+        return changed
+
+    def append(self, values):
+        """
+        Append timestamps to all the members.
+
+        Parameters
+        ----------
+        values : numpy array
+            members x new timestamps
+
+        Returns
+        -------
+        changed : numpy array
+            True for the segments whose earlier timestamps
+            changed, the new ones being always computed
+        """
+        nPrevious = self.result.nColumns
+        self.members.append(values)
+        self.updateStats(np.arange(len(values)), values)
+        changed = np.zeros(self.nSegments, dtype = bool)
+        if self.method in ['minStd', 'maxStd']:
+            changed = self.select() & (nPrevious > 0)
+            self.result.append(getSelectedRows(values, self.selected))
+        elif self.method == 'normalZ':
+            self.result.append(np.empty((self.nSegments, values.shape[1])))
+            changed[:] = nPrevious > 0
+        else:
+            self.result.append(getSegmentAggregate(values, self.offsets, self.method))
+        if changed.any() or self.method == 'normalZ':
+            self.aggregateSegments(np.flatnonzero(changed))
+        return changed
+
+    def replace(self, members, values):
+        """
+        Replace all the timestamps of some members.
+
+        Parameters
+        ----------
+        members : numpy array
+        values : numpy array
+            members x all the timestamps
+
+        Returns
+        -------
+        changed : numpy array
+            True for the segments of the members
+        """
+        self.members.values[members] = values
+        self.count[members] = 0
+        self.mean[members] = 0
+        self.m2[members] = 0
+        self.updateStats(members, values)
+        changed = np.zeros(self.nSegments, dtype = bool)
+        changed[self.segments[members]] = True
+        if self.method in ['minStd', 'maxStd']:
+            self.select()
+        self.aggregateSegments(np.flatnonzero(changed))
+        return changed
@@ -0,0 +1,104 @@
+"""
+Benchmarks of the BioCyc fetch layer against a local stand-in
+server. Run: python benchmark_requests.py
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import time
+import handle_requests as hr
+from handle_fetch import FetchStats, fetchAll
+from stub_biocyc import StubBiocycServer, makeDocuments
+
+nReactions = 300
+nPathways = 60
+concurrencies = [1, 4, 16]
+rates = [None, 100.0, 25.0] # requests per second, None for no limit
+faultProfiles = {
+    'clean': {'latency': 0.02},
+    'throttled': {'latency': 0.02, 'throttleRate': 0.05},
+    'flaky': {'latency': 0.02, 'errorRate': 0.03, 'timeoutRate': 0.01}}
+
+def runBenchmark(server, reactions, maxWorkers, rate, backoff = 0.05):
+    """
+    Fetch the pathways of reactions through the stand-in
+    server and measure the fetch layer.
+
+    Parameters
+    ----------
+    server: stub_biocyc.StubBiocycServer
+    reactions: list
+    maxWorkers: int
+    rate: float
+    backoff: float
+        the first delay in seconds between two attempts
+
+    Returns
+    -------
+    result: dict
+    """
+    # a new session is sized for the concurrency
+    hr.session = None
+    hr.maxConcurrentRequests = maxWorkers
+    stats = FetchStats()
+    started = time.monotonic()
+    results, errors = fetchAll(reactions, hr.getReactionPathwayIds,
+                               maxWorkers = maxWorkers, rate = rate,
+                               backoff = backoff, stats = stats)
+    elapsed = time.monotonic() - started
+    result = {'workers': maxWorkers, 'rate': rate,
+              'seconds': elapsed,
+              'throughput': len(results) / elapsed,
+              'p50': stats.getPercentile(50),
+              'p95': stats.getPercentile(95),
+              'p99': stats.getPercentile(99),
+              'retries': stats.attempts - len(results),
+              'throttled': stats.throttled,
+              'transient': stats.transient,
+              'failed': len(errors)}
+    return result
+
+def printResult(profile, result):
+    """
+    Print one line of the benchmark table.
+
+    Parameters
+    ----------
+    profile: str
+    result: dict
+    """
+    rate = 'none' if result['rate'] is None else f"{result['rate']:.0f}/s"
+    print(f"{profile:>10} {result['workers']:>7} {rate:>7} "
+          f"{result['seconds']:>8.2f} {result['throughput']:>8.1f} "
+          f"{result['p50'] * 1000:>7.1f} {result['p95'] * 1000:>7.1f} "
+          f"{result['p99'] * 1000:>7.1f} {result['retries']:>7} "
+          f"{result['failed']:>6}")
+
+def main():
+    documents = makeDocuments(nReactions, nPathways)
+    reactions = [ID for ID in documents if ID.startswith('RXN-')]
+    hr.logRequests = False
+    hr.setResponseCache(None)
+    hr.requestTimeout = 0.5
+    print(f"{'profile':>10} {'workers':>7} {'rate':>7} {'seconds':>8} "
+          f"{'req/s':>8} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} "
+          f"{'retries':>7} {'failed':>6}")
+    for profile, faults in faultProfiles.items():
+        server = StubBiocycServer(documents, timeoutDelay = 1.0, **faults)
+        server.start()
+        hr.biocycURL = server.url
+        try:
+            for maxWorkers in concurrencies:
+                for rate in rates:
+                    printResult(profile, runBenchmark(server, reactions,
+                                                      maxWorkers, rate))
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Check the genes read from gene-protein-reaction rules,
+malformed rules included.
+Run: python check_gpr.py
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+from handle_reactions import getGPRGenes
+
+# rule and its expected genes
+cases = [
+    ("", ()),
+    ("('thrA')", ('thrA',)),
+    ("('thrA') or ('metL' and 'thrB')", ('thrA', 'metL', 'thrB')),
+    ("(a or b) and c", ('a', 'c', 'b')),
+    ("a AND b Or a", ('a', 'b')),
+    ("[a or {b and c}]", ('a', 'b', 'c')),
+    # unclosed bracket, tolerated by the parser
+    ("(a and (b", ('a', 'b')),
+    # malformed rules : their words are kept
+    ("a or b)) and c", ('a', 'b', 'c')),
+    ("'thrA", ('thrA',)),
+    ("thrA's", ('thrA', 's')),
+    ("'thrA' or 'thrB", ('thrA', 'thrB')),
+    ("and or", ()),
+]
+
+def main():
+    isPassed = True
+    for rule, expected in cases:
+        try:
+            genes = getGPRGenes(rule)
+        except Exception as e:
+            genes = e
+        isSame = genes == expected
+        isPassed &= isSame
+        print(f"{rule!r:>36} {'ok' if isSame else f'got {genes!r}'}")
+    if not isPassed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
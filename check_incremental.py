@@ -0,0 +1,142 @@
+"""
+Check that appending timestamps one batch at a time gives
+exactly the reactions and pathways expression computed from
+scratch on all the timestamps, on a synthetic dataset.
+Run: python check_incremental.py
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import numpy as np
+from handle_genes import ExpressionDataset
+from handle_reactions import ReactionExpressionUpdater, getAllReactionsExpression
+from handle_pathways import PathwayExpressionUpdater, getAllPathwaysExpressionFromReactions
+
+nGenes = 300
+nReactions = 200
+nPathways = 40
+batches = [3, 1, 4, 2, 6] # timestamps appended at once
+# (reactions, pathways) methods, the first one being the main.py default
+methods = [('normalZ', 'upDownZ'), ('mean', 'upDownZ'), ('upDownZ', 'mean'),
+           ('minStd', 'upDownZ'), ('maxStd', 'maxStd')]
+
+def makeDataset(rng, nTimestamps):
+    """
+    Generate a dataset of small integers, so that many
+    Z-scores and ratios are exactly 0.
+
+    Parameters
+    ----------
+    rng: numpy.random.Generator
+    nTimestamps: int
+
+    Returns
+    -------
+    dataset: handle_genes.ExpressionDataset
+    levels: numpy array
+    ratios: numpy array
+    """
+    levels = rng.integers(0, 3, (nGenes, nTimestamps)).astype('float64')
+    ratios = rng.integers(-1, 2, (nGenes, nTimestamps)).astype('float64')
+    levels[rng.random(levels.shape) < 0.01] = np.nan
+    ratios[rng.random(ratios.shape) < 0.01] = np.nan
+    loci = [f'b{i:04d}' for i in range(nGenes)]
+    geneToLocus = {f'gene{i}': locus for i, locus in enumerate(loci)}
+    dataset = ExpressionDataset('synthetic', loci, geneToLocus,
+                                levels[:, :batches[0]].copy(), ratios[:, :batches[0]].copy())
+    return dataset, levels, ratios
+
+def makeModel(rng):
+    """
+    Generate random reactions and pathways.
+
+    Parameters
+    ----------
+    rng: numpy.random.Generator
+
+    Returns
+    -------
+    reactionIdToGenes: dict
+    pathwayIdToReactions: dict
+    """
+    reactionIdToGenes = {}
+    for r in range(nReactions):
+        size = rng.integers(0, 5)
+        reactionIdToGenes[f'RXN-{r}'] = [f'gene{g}' for g in rng.choice(nGenes, size, replace = False)]
+    pathwayIdToReactions = {}
+    for p in range(nPathways):
+        size = rng.integers(1, 12)
+        pathwayIdToReactions[f'PWY-{p}'] = [f'RXN-{r}' for r in rng.choice(nReactions, size, replace = False)]
+    return reactionIdToGenes, pathwayIdToReactions
+
+def isSame(expected, computed):
+    """
+    Compare two expression dicts bit for bit, NaN included.
+
+    Parameters
+    ----------
+    expected: dict
+    computed: dict
+
+    Returns
+    -------
+    boolean
+    """
+    return all(np.array_equal(expected[key], computed[key], equal_nan = True)
+               for key in expected) and expected.keys() == computed.keys()
+
+def checkMethods(reactionMethod, pathwayMethod, seed = 0):
+    """
+    Append the timestamps in batches and compare the updaters
+    with a full computation after each batch.
+
+    Parameters
+    ----------
+    reactionMethod: str
+    pathwayMethod: str
+    seed: int
+
+    Returns
+    -------
+    boolean
+    """
+    rng = np.random.default_rng(seed)
+    dataset, levels, ratios = makeDataset(rng, sum(batches))
+    reactionIdToGenes, pathwayIdToReactions = makeModel(rng)
+    reactionIds = list(reactionIdToGenes)
+    reactionUpdater = ReactionExpressionUpdater(reactionIds, reactionIdToGenes,
+                                                reactionMethod, dataset)
+    pathwayUpdater = PathwayExpressionUpdater(pathwayIdToReactions, reactionUpdater,
+                                              pathwayMethod)
+    start = batches[0]
+    for size in [0] + batches[1:]:
+        if size > 0:
+            dataset.appendTimepoints(levels[:, start:start + size], ratios[:, start:start + size])
+            start += size
+            pathwayUpdater.update(reactionUpdater.update())
+        reactionIdToExpression = getAllReactionsExpression(reactionIds, reactionIdToGenes,
+                                                           reactionMethod, dataset)
+        pathwaysExpression = getAllPathwaysExpressionFromReactions(
+            pathwayIdToReactions, reactionIdToExpression, pathwayMethod)
+        if not (isSame(reactionIdToExpression, reactionUpdater.getReactionsExpression())
+                and isSame(pathwaysExpression, pathwayUpdater.getPathwaysExpression())):
+            return False
+    return True
+
+def main():
+    isPassed = True
+    for reactionMethod, pathwayMethod in methods:
+        isSameResult = checkMethods(reactionMethod, pathwayMethod)
+        isPassed &= isSameResult
+        print(f"{reactionMethod:>8} {pathwayMethod:>8} "
+              f"{'identical' if isSameResult else 'DIFFERENT'}")
+    if not isPassed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
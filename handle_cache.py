@@ -0,0 +1,196 @@
+"""
+This library is dedicated to the on-disk cache of BioCyc responses.
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import sqlite3
+import threading
+import time
+import zlib
+
+class CacheMissError(LookupError):
+    """
+    Raised in cache-only mode when a response is not cached.
+    """
+
+class ResponseCache:
+    """
+    SQLite cache of BioCyc responses keyed by organism and
+    frame id. Bodies are stored zlib-compressed.
+
+    Parameters
+    ----------
+    filename: str
+        the SQLite database file
+    ttl: float
+        the lifetime of an entry in seconds, None to keep
+        entries forever
+    maxSize: int
+        the maximum size of the stored bodies in bytes, the
+        least recently used entries are evicted beyond it.
+        None for an unbounded cache
+    cacheOnly: bool
+        if True, a miss raises CacheMissError instead of
+        letting the caller download the object
+    """
+
+    def __init__(self, filename, ttl = None, maxSize = None,
+                 cacheOnly = False):
+        self.filename = filename
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.cacheOnly = cacheOnly
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the connection is shared between fetching threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename,
+                                          check_same_thread = False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                organism TEXT NOT NULL,
+                frameid TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                fetched REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (organism, frameid))""")
+        self.connection.execute("""
+            CREATE INDEX IF NOT EXISTS responses_accessed
+            ON responses (accessed)""")
+        self.connection.commit()
+
+    def isExpired(self, fetched):
+        """
+        Check if an entry fetched at a given time is expired.
+        Expired entries are still served in cache-only mode.
+
+        Parameters
+        ----------
+        fetched: float
+            the timestamp of the download
+
+        Returns
+        -------
+        boolean
+        """
+        if self.ttl is None or self.cacheOnly:
+            return False
+        return time.time() - fetched > self.ttl
+
+    def get(self, organism, frameId):
+        """
+        Return a cached response.
+
+        Parameters
+        ----------
+        organism: str
+            the BioCyc organism, e.g. 'ECOLI'
+        frameId: str
+            the id of the requested object
+
+        Returns
+        -------
+        response: tuple
+            the HTTP status code (int) and the body (bytes),
+            or None if the response is not cached
+        """
+        with self.lock:
+            row = self.connection.execute(
+                """SELECT status, body, fetched FROM responses
+                   WHERE organism = ? AND frameid = ?""",
+                (organism, frameId)).fetchone()
+            if row is None or self.isExpired(row[2]):
+                self.misses += 1
+                if self.cacheOnly:
+                    raise CacheMissError(f"{organism}:{frameId} is not cached")
+                return None
+            self.hits += 1
+            self.connection.execute(
+                """UPDATE responses SET accessed = ?
+                   WHERE organism = ? AND frameid = ?""",
+                (time.time(), organism, frameId))
+            self.connection.commit()
+        status, body, fetched = row
+        return status, zlib.decompress(body)
+
+    def put(self, organism, frameId, status, body):
+        """
+        Store a response, then evict the least recently
+        used entries if the cache is too large.
+
+        Parameters
+        ----------
+        organism: str
+        frameId: str
+        status: int
+            the HTTP status code of the response
+        body: bytes
+            the raw body of the response
+        """
+        compressed = zlib.compress(body)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                """INSERT OR REPLACE INTO responses
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (organism, frameId, status, compressed,
+                 len(compressed), now, now))
+            if self.maxSize is not None:
+                self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the
+        stored bodies fit in maxSize. The lock must be held.
+        """
+        totalSize = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if totalSize <= self.maxSize:
+            return
+        rows = self.connection.execute(
+            """SELECT organism, frameid, size FROM responses
+               ORDER BY accessed""")
+        toDelete = []
+        for organism, frameId, size in rows:
+            if totalSize <= self.maxSize:
+                break
+            toDelete.append((organism, frameId))
+            totalSize -= size
+        self.connection.executemany(
+            "DELETE FROM responses WHERE organism = ? AND frameid = ?",
+            toDelete)
+        self.evictions += len(toDelete)
+
+    def getStats(self):
+        """
+        Return the hit/miss counters of the cache.
+
+        Returns
+        -------
+        stats: dict
+        """
+        with self.lock:
+            entries, size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()
+        stats = {'hits': self.hits, 'misses': self.misses,
+                 'evictions': self.evictions,
+                 'entries': entries, 'size': size}
+        return stats
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,251 @@
+"""
+This library is dedicated to concurrent and rate-limited fetching.
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class TransientError(Exception):
+    """
+    Raised by a fetch function when a request failed for a
+    temporary reason (timeout, connection error, HTTP 5xx).
+    The request is retried.
+    """
+
+class ThrottledError(TransientError):
+    """
+    Raised by a fetch function when the server asks to slow
+    down (HTTP 429) or is overloaded (HTTP 503). The request
+    is retried at a lower rate.
+
+    Parameters
+    ----------
+    status: int
+        the HTTP status code
+    retryAfter: float
+        the delay in seconds requested by the server, if any
+    """
+
+    def __init__(self, status, retryAfter = None):
+        super().__init__(f"throttled ({status})")
+        self.status = status
+        self.retryAfter = retryAfter
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting the request rate.
+    The rate is halved when the server throttles us and
+    slowly raised back to its initial value on success.
+
+    Parameters
+    ----------
+    rate: float
+        the maximum number of requests per second
+    capacity: int
+        the maximum number of requests sent in a burst
+    """
+
+    def __init__(self, rate, capacity = 1):
+        self.maxRate = rate
+        self.minRate = rate / 64
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request can be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slowDown(self):
+        """
+        Halve the rate (multiplicative decrease).
+        """
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2)
+
+    def speedUp(self):
+        """
+        Raise the rate by a tenth of its initial value
+        (additive increase).
+        """
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.maxRate / 10)
+
+class FetchStats:
+    """
+    Thread-safe counters of a fetchAll() run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.throttled = 0
+        self.transient = 0
+        self.latencies = []
+
+    def addAttempt(self, error = None):
+        """
+        Count an attempt and its temporary failure, if any.
+
+        Parameters
+        ----------
+        error: TransientError
+        """
+        with self.lock:
+            self.attempts += 1
+            if isinstance(error, ThrottledError):
+                self.throttled += 1
+            elif error is not None:
+                self.transient += 1
+
+    def addLatency(self, latency):
+        """
+        Record the time spent on one object, retries included.
+
+        Parameters
+        ----------
+        latency: float
+            in seconds
+        """
+        with self.lock:
+            self.latencies.append(latency)
+
+    def getPercentile(self, q):
+        """
+        Return a percentile of the recorded latencies.
+
+        Parameters
+        ----------
+        q: float
+            between 0 and 100
+
+        Returns
+        -------
+        float
+        """
+        latencies = sorted(self.latencies)
+        if len(latencies) == 0:
+            return float('nan')
+        rank = min(len(latencies) - 1, int(q / 100 * len(latencies)))
+        return latencies[rank]
+
+def fetchWithRetries(ID, fetchOne, bucket, maxRetries, backoff,
+                     stats = None):
+    """
+    Fetch one object, retrying with an exponential backoff
+    when the request failed for a temporary reason.
+
+    Parameters
+    ----------
+    ID: str
+        the id of the requested object
+    fetchOne: function
+        called with ID, returns the fetched object
+    bucket: TokenBucket
+        the rate limiter, or None
+    maxRetries: int
+        the maximum number of retries
+    backoff: float
+        the first delay in seconds between two attempts
+    stats: FetchStats
+        counters updated with this fetch, if given
+
+    Returns
+    -------
+    the result of fetchOne(ID)
+    """
+    delay = backoff
+    started = time.monotonic()
+    for attempt in range(maxRetries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            result = fetchOne(ID)
+        except TransientError as e:
+            if stats is not None:
+                stats.addAttempt(e)
+            retryAfter = None
+            if isinstance(e, ThrottledError):
+                retryAfter = e.retryAfter
+                if bucket is not None:
+                    bucket.slowDown()
+            if attempt == maxRetries:
+                raise
+            # the jitter avoids retrying all the threads at once
+            time.sleep(retryAfter or delay * random.uniform(1, 1.5))
+            delay *= 2
+        else:
+            if bucket is not None:
+                bucket.speedUp()
+            if stats is not None:
+                stats.addAttempt()
+                stats.addLatency(time.monotonic() - started)
+            return result
+
+def fetchAll(ids, fetchOne, maxWorkers = 4, rate = 2.0,
+             maxRetries = 5, backoff = 1.0, stats = None):
+    """
+    Fetch many objects concurrently while limiting the
+    request rate. Duplicate ids are fetched once.
+
+    Parameters
+    ----------
+    ids: list
+        the ids of the requested objects
+    fetchOne: function
+        called with an id, returns the fetched object
+    maxWorkers: int
+        the number of requests in flight
+    rate: float
+        the maximum number of requests per second,
+        None for no limit
+    maxRetries: int
+        the maximum number of retries per object
+    backoff: float
+        the first delay in seconds between two attempts
+    stats: FetchStats
+        counters updated with this run, if given
+
+    Returns
+    -------
+    results: dict
+        id as key and fetched object as value
+    errors: dict
+        id as key and raised exception as value
+    """
+    ids = list(dict.fromkeys(ids))
+    bucket = None if rate is None else TokenBucket(rate)
+    with ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+        futures = {ID: executor.submit(fetchWithRetries, ID, fetchOne,
+                                       bucket, maxRetries, backoff, stats)
+                   for ID in ids}
+        results, errors = {}, {}
+        for ID in ids:
+            try:
+                results[ID] = futures[ID].result()
+            except Exception as e:
+                errors[ID] = e
+    return results, errors
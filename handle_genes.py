@@ -9,24 +9,518 @@ Library to interact with our gene expression data files.
 @ SIMON Arnaud
 """
 
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
+from aggregate_data import ColumnBuffer
 
 genesFilename = "mapGeneLocus.csv"
 levelsFilename = "ecoliK12_levels.csv"
 ratiosFilename = "ecoliK12_ratio.csv"
+expressionCacheDirectory = "expressionCache"
+# 'float32' halves the memory of large expression panels
+expressionDtype = "float64"
+# rows read at once when streaming the expression files
+expressionChunkSize = 50000
+# default ExpressionDataset, set by loadGeneFiles()
+dataset = None
 
-def loadGeneFiles():
+class ExpressionDataset:
+    """
+    One expression experiment, indexed by gene name and locus.
+    Levels and ratios are NumPy matrices with one row per
+    locus, to which timestamps can be appended. Several
+    datasets can be scored against the same graph.
+    
+    Parameters
+    ----------
+    name: str
+        the name of the experiment
+    loci: list
+        the locus of each matrices row
+    geneToLocus: dict
+        gene name as key and locus as value, for the genes
+        with a measured locus
+    levels: numpy array
+        expression levels, one column per timestamp
+    ratios: numpy array
+        differential expressions, one column per timestamp
+    """
+
+    def __init__(self, name, loci, geneToLocus, levels, ratios):
+        self.name = name
+        self.loci = loci
+        self.locusToRow = {locus: i for i, locus in enumerate(loci)}
+        self.geneToLocus = geneToLocus
+        self.geneToRow = {geneName: self.locusToRow[locus]
+                          for geneName, locus in geneToLocus.items()}
+        self.measuredGenes = frozenset(geneToLocus)
+        # the matrices are shared : never modified in place
+        levels.setflags(write = False)
+        ratios.setflags(write = False)
+        self.levels = levels
+        self.ratios = ratios
+        # created by the first appendTimepoints()
+        self.buffers = None
+
+    def appendTimepoints(self, levels, ratios):
+        """
+        Append timestamps measured after the dataset was loaded.
+        The matrices are then views of buffers with a spare
+        capacity : the earlier timestamps are not copied at
+        each append.
+        
+        Parameters
+        ----------
+        levels: numpy array
+            expression levels, one row per locus in the order
+            of loci, one column per new timestamp
+        ratios: numpy array
+            differential expressions, as levels
+        """
+        if self.buffers is None:
+            self.buffers = {}
+            for dataType, matrix in [('level', self.levels), ('ratio', self.ratios)]:
+                self.buffers[dataType] = ColumnBuffer(len(self.loci), matrix.dtype)
+                self.buffers[dataType].append(matrix)
+        self.buffers['level'].append(levels)
+        self.buffers['ratio'].append(ratios)
+        self.levels = self.buffers['level'].values
+        self.ratios = self.buffers['ratio'].values
+        self.levels.setflags(write = False)
+        self.ratios.setflags(write = False)
+
+    def getTimestampCount(self):
+        """
+        Return the number of timestamps of the dataset.
+        
+        Returns
+        -------
+        int
+        """
+        return self.levels.shape[1]
+
+    def hasGeneData(self, geneName):
+        """
+        Check if the expression of a gene was measured.
+        
+        Parameters
+        ----------
+        geneName: str
+        
+        Returns
+        -------
+        boolean
+        """
+        return geneName in self.measuredGenes
+
+    def filterGenesWithData(self, geneNames):
+        """
+        Keep the genes with a measured expression.
+        
+        Parameters
+        ----------
+        geneNames: list
+        
+        Returns
+        -------
+        list
+            the measured genes, in their input order
+        """
+        return [g for g in geneNames if g in self.measuredGenes]
+
+    def getGeneRow(self, geneName):
+        """
+        Return the matrices row of a gene.
+        
+        Parameters
+        ----------
+        geneName: str
+        
+        Returns
+        -------
+        row: int
+
+        Raises
+        ------
+        KeyError
+            if the gene has no measured expression
+        """
+        return self.geneToRow[geneName]
+
+    def getGeneRows(self, geneNames):
+        """
+        Return the matrices rows of genes.
+        
+        Parameters
+        ----------
+        geneNames: list
+        
+        Returns
+        -------
+        rows: numpy array
+
+        Raises
+        ------
+        KeyError
+            if a gene has no measured expression
+        """
+        rows = np.fromiter((self.geneToRow[g] for g in geneNames),
+                           dtype = np.intp, count = len(geneNames))
+        return rows
+
+    def getLocusRows(self, locus):
+        """
+        Return the matrices rows of a locus as a slice, empty
+        if the locus was not measured.
+        
+        Parameters
+        ----------
+        locus: str
+        
+        Returns
+        -------
+        slice
+        """
+        row = self.locusToRow.get(locus)
+        if row is None:
+            return slice(0, 0)
+        return slice(row, row + 1)
+
+    def getGenesData(self, geneNames, dataType):
+        """
+        Return the expression data of genes, one row per gene.
+        The result is a read-only view of the dataset matrix when
+        the genes rows are consecutive, a copy otherwise.
+        
+        Parameters
+        ----------
+        geneNames: list
+        dataType: str
+            'level' or 'ratio'
+        
+        Returns
+        -------
+        numpy array
+        """
+        matrix = self.levels if dataType == 'level' else self.ratios
+        rows = self.getGeneRows(geneNames)
+        if len(rows) > 0 and np.all(np.diff(rows) == 1):
+            return matrix[rows[0]:rows[-1] + 1]
+        return matrix[rows]
+
+def getExpressionDataset(name, genes, levels, ratios, dtype = 'float64'):
+    """
+    Index expression DataFrames in an ExpressionDataset, in
+    the order of the levels rows.
+    
+    Parameters
+    ----------
+    name: str
+    genes: pandas.DataFrame
+        with 'gene name' and 'locus' columns
+    levels: pandas.DataFrame
+        with a 'locus' column and one column per timestamp
+    ratios: pandas.DataFrame
+        with a 'locus' column and one column per timestamp
+    dtype: str
+        'float64' or 'float32'
+    
+    Returns
+    -------
+    ExpressionDataset
+    """
+    # the first row of a locus or a gene wins, as with
+    # the former DataFrame masks
+    levels = levels.drop_duplicates('locus')
+    loci = levels['locus'].tolist()
+    levelsMatrix = np.ascontiguousarray(
+        levels.drop('locus', axis = 1).to_numpy(dtype = dtype))
+    # loci without ratios get NaN rows
+    ratios = ratios.drop_duplicates('locus').set_index('locus')
+    ratiosMatrix = np.ascontiguousarray(
+        ratios.reindex(loci).to_numpy(dtype = dtype))
+    measuredLoci = set(loci)
+    geneToLocus = {}
+    for geneName, locus in zip(genes['gene name'], genes['locus']):
+        if locus in measuredLoci and geneName not in geneToLocus:
+            geneToLocus[geneName] = locus
+    return ExpressionDataset(name, loci, geneToLocus, levelsMatrix, ratiosMatrix)
+
+def getFileFingerprint(filename, withHash):
+    """
+    Return the size, modification time and optionally the
+    SHA-256 of a file.
+    
+    Parameters
+    ----------
+    filename: str
+    withHash: bool
+    
+    Returns
+    -------
+    fingerprint: dict
+    """
+    stat = os.stat(filename)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if withHash:
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha.update(chunk)
+        fingerprint['sha256'] = sha.hexdigest()
+    return fingerprint
+
+def isFileUnchanged(filename, fingerprint):
+    """
+    Check a file against its cached fingerprint. The content
+    is only hashed when the size matches but not the
+    modification time, which is then updated in fingerprint
+    if the content is unchanged.
+    
+    Parameters
+    ----------
+    filename: str
+    fingerprint: dict
+        from getFileFingerprint(filename, withHash = True)
+    
+    Returns
+    -------
+    boolean
+        False if the file can no longer be read
+    """
+    try:
+        current = getFileFingerprint(filename, withHash = False)
+        if current['size'] != fingerprint['size']:
+            return False
+        if current['mtime'] == fingerprint['mtime']:
+            return True
+        current = getFileFingerprint(filename, withHash = True)
+    except OSError:
+        return False
+    if current['sha256'] != fingerprint['sha256']:
+        return False
+    fingerprint['mtime'] = current['mtime']
+    return True
+
+def saveExpressionCache(dataset, filenames, cacheDirectory):
+    """
+    Save an ExpressionDataset in a binary cache: one .npy file
+    per matrix and a JSON index, written last.
+    
+    Parameters
+    ----------
+    dataset: ExpressionDataset
+    filenames: list
+        the source files of the dataset
+    cacheDirectory: str
+    """
+    os.makedirs(cacheDirectory, exist_ok = True)
+    for name, matrix in [('levels', dataset.levels), ('ratios', dataset.ratios)]:
+        temporary = os.path.join(cacheDirectory, f'{name}.tmp.npy')
+        np.save(temporary, matrix)
+        os.replace(temporary, os.path.join(cacheDirectory, f'{name}.npy'))
+    index = {'sources': {f: getFileFingerprint(f, withHash = True)
+                         for f in filenames},
+             'loci': dataset.loci,
+             'geneToLocus': dataset.geneToLocus}
+    temporary = os.path.join(cacheDirectory, 'index.tmp.json')
+    with open(temporary, 'w') as f:
+        json.dump(index, f)
+    os.replace(temporary, os.path.join(cacheDirectory, 'index.json'))
+
+def loadExpressionCache(name, filenames, cacheDirectory, dtype = 'float64'):
+    """
+    Load an ExpressionDataset from the binary cache if its
+    source files are unchanged. The matrices are memory-mapped
+    read-only, so their pages are shared between processes
+    and only loaded when read.
+    
+    Parameters
+    ----------
+    name: str
+    filenames: list
+        the source files of the dataset
+    cacheDirectory: str
+    dtype: str
+        the expected dtype of the cached matrices
+    
+    Returns
+    -------
+    ExpressionDataset, or None if the cache is missing or stale
+    """
+    try:
+        with open(os.path.join(cacheDirectory, 'index.json')) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if list(index['sources']) != list(filenames):
+        return None
+    touched = False
+    for filename, fingerprint in index['sources'].items():
+        mtime = fingerprint['mtime']
+        if not isFileUnchanged(filename, fingerprint):
+            return None
+        touched = touched or fingerprint['mtime'] != mtime
+    # avoid hashing touched files again on the next load
+    if touched:
+        temporary = os.path.join(cacheDirectory, 'index.tmp.json')
+        with open(temporary, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary, os.path.join(cacheDirectory, 'index.json'))
+    try:
+        levels = np.load(os.path.join(cacheDirectory, 'levels.npy'), mmap_mode = 'r')
+        ratios = np.load(os.path.join(cacheDirectory, 'ratios.npy'), mmap_mode = 'r')
+    except (OSError, ValueError):
+        return None
+    if levels.dtype != dtype or ratios.dtype != dtype:
+        return None
+    return ExpressionDataset(name, index['loci'], index['geneToLocus'],
+                             levels, ratios)
+
+def getCacheDirectory(filenames, geneNames = None, timepoints = None):
+    """
+    Return the binary cache directory of a set of files,
+    pruned to some genes and timepoints.
+    
+    Parameters
+    ----------
+    filenames: list
+    geneNames: set
+    timepoints: list
+    
+    Returns
+    -------
+    str
+    """
+    key = '|'.join(os.path.abspath(f) for f in filenames)
+    if geneNames is not None:
+        key += '|genes:' + ','.join(sorted(geneNames))
+    if timepoints is not None:
+        key += '|timepoints:' + ','.join(timepoints)
+    return os.path.join(expressionCacheDirectory,
+                        hashlib.sha1(key.encode()).hexdigest()[:16])
+
+def readExpressionFile(filename, loci = None, timepoints = None,
+                       dtype = 'float64'):
+    """
+    Read an expression file by chunks of expressionChunkSize
+    rows, keeping only some loci and timepoints. The values
+    are parsed directly with the requested dtype.
+    
+    Parameters
+    ----------
+    filename: str
+    loci: set
+        the loci to keep, all if None
+    timepoints: list
+        the timepoint columns to keep, all if None
+    dtype: str
+        'float64' or 'float32'
+    
+    Returns
+    -------
+    pandas.DataFrame
+        with a 'locus' column and one column per timepoint
+    """
+    header = pd.read_csv(filename, sep = ';', nrows = 0).columns
+    if timepoints is None:
+        timepoints = [c for c in header if c != 'locus']
+    columns = ['locus'] + list(timepoints)
+    dtypes = {c: dtype for c in timepoints}
+    dtypes['locus'] = str
+    chunks = [pd.DataFrame({c: pd.Series(dtype = dtypes[c]) for c in columns})]
+    for chunk in pd.read_csv(filename, sep = ';', usecols = columns,
+                             dtype = dtypes, chunksize = expressionChunkSize):
+        if loci is not None:
+            chunk = chunk[chunk['locus'].isin(loci)]
+        chunks.append(chunk[columns])
+    return pd.concat(chunks, ignore_index = True)
+
+def loadExpressionDataset(genesFile, levelsFile, ratiosFile, name = None,
+                          useCache = True, dtype = None, geneNames = None,
+                          timepoints = None):
     """
     Load 3 Files : the locus, their expression levels,
-    and their differential expression.
+    and their differential expression, and index them
+    in an ExpressionDataset. 
+    
+    Parameters
+    ----------
+    genesFile: str
+    levelsFile: str
+    ratiosFile: str
+    name: str
+        the name of the dataset, levelsFile if None
+    useCache: bool
+        if True, the dataset is read from the binary cache when
+        the files are unchanged, and cached otherwise. The
+        matrices are then always memory-mapped
+    dtype: str
+        'float64' or 'float32', expressionDtype if None
+    geneNames: set
+        if given, only the loci of these genes are kept while
+        streaming the expression files, e.g. the genes of
+        handle_reactions.getAssociatedGenes()
+    timepoints: list
+        if given, only these timepoint columns are kept
+    
+    Returns
+    -------
+    ExpressionDataset
+    """
+    name = name or levelsFile
+    dtype = dtype or expressionDtype
+    filenames = [genesFile, levelsFile, ratiosFile]
+    cacheDirectory = getCacheDirectory(filenames, geneNames, timepoints)
+    if useCache:
+        dataset = loadExpressionCache(name, filenames, cacheDirectory, dtype)
+        if dataset is not None:
+            return dataset
+    genes = pd.read_csv(genesFile, sep = ';')
+    loci = None
+    if geneNames is not None:
+        genes = genes[genes['gene name'].isin(geneNames)]
+        loci = set(genes['locus'])
+    levels = readExpressionFile(levelsFile, loci, timepoints, dtype)
+    ratios = readExpressionFile(ratiosFile, loci, timepoints, dtype)
+    dataset = getExpressionDataset(name, genes, levels, ratios, dtype)
+    if useCache:
+        saveExpressionCache(dataset, filenames, cacheDirectory)
+        # swap the parsed matrices for their memory maps
+        dataset = loadExpressionCache(name, filenames, cacheDirectory, dtype)
+    return dataset
+
+def loadGeneFiles(useCache = True, dtype = None, geneNames = None,
+                  timepoints = None):
+    """
+    Load the default dataset, used by the functions without
+    an explicit dataset.
+    
+    Parameters
+    ----------
+    useCache: bool
+        if True, the dataset is read from the binary cache
+    dtype: str
+        'float64' or 'float32', expressionDtype if None
+    geneNames: set
+        if given, only the loci of these genes are loaded
+    timepoints: list
+        if given, only these timepoint columns are loaded
+    
+    Returns
+    -------
+    ExpressionDataset
     """
-    # genes, levels and ratios are directly called
-    # by other functions : use global
-    global genes, levels, ratios
-    genes = pd.read_csv(genesFilename, sep = ';')
-    levels = pd.read_csv(levelsFilename, sep = ';')
-    ratios = pd.read_csv(ratiosFilename, sep = ';')
-    genes = genes[genes['locus'].isin(levels['locus'])]
+    # the dataset is directly called by other functions : use global
+    global dataset
+    dataset = loadExpressionDataset(genesFilename, levelsFilename,
+                                    ratiosFilename, useCache = useCache,
+                                    dtype = dtype, geneNames = geneNames,
+                                    timepoints = timepoints)
+    return dataset
 
 def getGeneLocus(geneName):
     """
@@ -42,7 +536,7 @@ def getGeneLocus(geneName):
     locus: str
         the locus corresponding to the gene 
     """
-    locus = genes.loc[genes['gene name'] == geneName, 'locus'].values[0]
+    locus = dataset.geneToLocus[geneName]
     return locus
 
 def getLocusLevel(locus):
@@ -59,7 +553,7 @@ def getLocusLevel(locus):
     expr: numpy array
         array of expression levels
     """
-    expr = levels.loc[levels['locus'] == locus].drop('locus', axis = 1).to_numpy()
+    expr = dataset.levels[dataset.getLocusRows(locus)]
     return expr
 
 def getLocusRatio(locus):
@@ -76,7 +570,7 @@ def getLocusRatio(locus):
     ratio: numpy array
         array of differential expressions
     """
-    ratio = ratios.loc[ratios['locus'] == locus].drop('locus', axis = 1).to_numpy()
+    ratio = dataset.ratios[dataset.getLocusRows(locus)]
     return ratio
 
 def getLocusData(locus):
@@ -129,8 +623,19 @@ def isGeneWithData(geneName):
     ------
     boolean
     """
-    try:
-        getGeneData(geneName)
-        return True
-    except IndexError:
-        return False
+    return dataset.hasGeneData(geneName)
+
+def filterGenesWithData(geneNames):
+    """ 
+    Keep the genes whose expression was measured.
+    
+    Parameters
+    ----------
+    geneNames: list
+        the genes names
+    
+    Return
+    ------
+    list
+    """
+    return dataset.filterGenesWithData(geneNames)
@@ -30,7 +30,8 @@ def getColorScale():
     colorScale.setColorAtPos(1.0, tlp.Color.Red)
     return colorScale
 
-def colorNodes(graph, propertyName, colorScale = getColorScale()):
+def colorNodes(graph, propertyName, colorScale = getColorScale(),
+               colorPropertyName = 'viewColor'):
     """
     Colorizes a graph's nodes according to the property values indicated.
 
@@ -39,12 +40,13 @@ def colorNodes(graph, propertyName, colorScale = getColorScale()):
     graph : tlp.Graph
     propertyName : name of the property used for the nodes color mapping
     colorScale : tlp.ColorScale a color scale
+    colorPropertyName : name of the color property set
     """
     params = tlp.getDefaultPluginParameters("Color Mapping", graph)
     params['property'] = graph[propertyName]
     params["type"] = "uniform"
     params["color scale"] = colorScale
-    graph.applyColorAlgorithm("Color Mapping", params)
+    graph.applyColorAlgorithm("Color Mapping", graph.getColorProperty(colorPropertyName), params)
 
 def getRootGraph():
     """
@@ -24,23 +24,19 @@ def convertToDataFrame(pathwaysExpression, expectedSize):
     ----------
     pathwaysExpression: dict
         dictionnary associating a pathwayId (key) to its
-        aggregated expression (value)
+        aggregated expression (value), NaN where not measured
     expectedSize: int
         corresponding to the number of time stamp
     
     Returns
     -------
     df: pandas.DataFrame
+        the pathways measured at every time stamp
     """
-    # fills with NA to call pd.DataFrame.from_records()
-    for pathway, expression in pathwaysExpression.items():
-        nExpressionValues = len(expression)
-        if nExpressionValues < expectedSize:
-            expression += [None] * (expectedSize - nExpressionValues)
-            pathwaysExpression[pathway] = expression
-    dataFrame =  pd.DataFrame.from_records(pathwaysExpression).T
-    dataFrame.columns = [f'tp {t+1}' for t in range(expectedSize)]
-    df = dataFrame.dropna().astype("float64") 
+    columns = [f'tp {t+1}' for t in range(expectedSize)]
+    dataFrame = pd.DataFrame.from_dict(pathwaysExpression, orient = 'index',
+                                       columns = columns, dtype = 'float64')
+    df = dataFrame.dropna()
     return df
 
 def getNodes(graph, nRows, nCols):
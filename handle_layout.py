@@ -0,0 +1,299 @@
+"""
+This library is dedicated to a persistent cache of graph
+layouts. Coordinates are saved on disk, keyed by a hash of
+the graph topology and of the layout parameters, so the
+same graph gets the same drawing from one run to the next.
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+from tulip import tlp
+
+layoutCacheDirectory = "layoutCache"
+layoutCacheSize = 20 # layouts kept per method and parameters
+# a changed graph starts from a cached layout holding at
+# least this share of its nodes, or is laid out from scratch
+warmStartRatio = 0.8
+refinementMethod = 'GEM (Frick)'
+refinementIterations = 100
+# run on cached coordinates overlapping the current node sizes
+overlapRemovalMethod = 'Fast Overlap Removal'
+
+def getNodeLabels(graph):
+    """
+    Return the label of each node, the identity of a node
+    across runs.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+
+    Returns
+    -------
+    labels : dict
+        node as key and label as value
+    """
+    viewLabel = graph['viewLabel']
+    return {n: viewLabel[n] for n in graph.getNodes()}
+
+def getTopologyKey(graph, labels):
+    """
+    Return a hash of the labelled nodes and edges of a graph,
+    independent of the order of creation.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+    labels : dict
+        see getNodeLabels()
+
+    Returns
+    -------
+    str
+    """
+    edges = sorted((labels[graph.source(e)], labels[graph.target(e)])
+                   for e in graph.getEdges())
+    topology = json.dumps([sorted(labels.values()), edges])
+    return hashlib.sha1(topology.encode()).hexdigest()
+
+def getCacheFilename(method, params, cacheDirectory):
+    """
+    Return the cache file of the layouts computed with a
+    method and its parameters.
+
+    Parameters
+    ----------
+    method : str
+        the name of the layout plugin
+    params : dict
+        the parameters given to the plugin
+    cacheDirectory : str
+
+    Returns
+    -------
+    str
+    """
+    key = json.dumps([method, params], sort_keys = True, default = str)
+    return os.path.join(cacheDirectory,
+                        hashlib.sha1(key.encode()).hexdigest()[:16] + '.json')
+
+def loadLayouts(filename):
+    """
+    Load the cached layouts, least recently used first.
+
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    layouts : dict
+        topology key as key and a dict of node label to
+        coordinates as value, empty if the cache is missing
+        or unreadable
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def saveLayouts(filename, layouts):
+    """
+    Save the layouts, dropping the least recently used ones
+    beyond layoutCacheSize.
+
+    Parameters
+    ----------
+    filename : str
+    layouts : dict
+    """
+    keys = list(layouts)[-layoutCacheSize:]
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+    temporary = filename + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump({key: layouts[key] for key in keys}, f)
+    os.replace(temporary, filename)
+
+def getPositions(graph, labels):
+    """
+    Return the coordinates of the nodes.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+    labels : dict
+
+    Returns
+    -------
+    positions : dict
+        node label as key and [x, y, z] as value
+    """
+    viewLayout = graph['viewLayout']
+    positions = {}
+    for n, label in labels.items():
+        coord = viewLayout[n]
+        positions[label] = [coord[0], coord[1], coord[2]]
+    return positions
+
+def setPositions(graph, labels, positions):
+    """
+    Move the nodes to their cached coordinates. A node
+    without coordinates is put at the barycenter of its
+    placed neighbors, or of all the placed nodes.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+    labels : dict
+    positions : dict
+        node label as key and [x, y, z] as value
+    """
+    viewLayout = graph['viewLayout']
+    placed = [positions[label] for label in labels.values() if label in positions]
+    center = [sum(c) / len(placed) for c in zip(*placed)] if placed else [0, 0, 0]
+    for n, label in labels.items():
+        if label in positions:
+            viewLayout[n] = tuple(positions[label])
+            continue
+        neighbors = [positions[labels[m]] for m in graph.getInOutNodes(n)
+                     if labels[m] in positions]
+        if neighbors:
+            viewLayout[n] = tuple(sum(c) / len(neighbors) for c in zip(*neighbors))
+        else:
+            viewLayout[n] = tuple(center)
+
+def getClosestLayout(layouts, labels):
+    """
+    Return the cached layout sharing the most nodes with
+    a graph.
+
+    Parameters
+    ----------
+    layouts : dict
+    labels : dict
+
+    Returns
+    -------
+    key : str
+        the topology key of the layout, None if no layout
+        shares a node
+    shared : int
+        the number of shared nodes
+    """
+    nodeLabels = set(labels.values())
+    closestKey, closestShared = None, 0
+    for key, positions in layouts.items():
+        shared = len(nodeLabels.intersection(positions))
+        if shared > closestShared:
+            closestKey, closestShared = key, shared
+    return closestKey, closestShared
+
+def refineLayout(graph, iterations = None):
+    """
+    Run a short force-directed pass from the current
+    coordinates of the nodes.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+    iterations : int
+        refinementIterations if None
+    """
+    params = tlp.getDefaultPluginParameters(refinementMethod, graph)
+    initialLayout = tlp.LayoutProperty(graph)
+    initialLayout.copy(graph['viewLayout'])
+    params['initial layout'] = initialLayout
+    params['max iterations'] = iterations or refinementIterations
+    graph.applyLayoutAlgorithm(refinementMethod, params)
+
+def hasOverlaps(graph):
+    """
+    Check whether two nodes overlap, each node being a disk
+    of the largest dimension of its size.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+
+    Returns
+    -------
+    boolean
+    """
+    viewLayout, viewSize = graph['viewLayout'], graph['viewSize']
+    nodes = list(graph.getNodes())
+    if len(nodes) < 2:
+        return False
+    centers = np.array([[viewLayout[n][0], viewLayout[n][1]] for n in nodes])
+    radii = np.array([max(viewSize[n][0], viewSize[n][1]) / 2 for n in nodes])
+    distances = np.sqrt(((centers[:, None, :] - centers[None, :, :]) ** 2).sum(axis = 2))
+    isOverlapping = distances < radii[:, None] + radii[None, :]
+    np.fill_diagonal(isOverlapping, False)
+    return bool(isOverlapping.any())
+
+def applyCachedLayout(graph, method, params = None, cacheDirectory = None):
+    """
+    Apply a layout algorithm through the cache. An unchanged
+    graph gets its cached coordinates, a slightly changed one
+    (see warmStartRatio) starts from the coordinates of the
+    closest cached layout and is refined, any other one is
+    laid out by the algorithm. Only the topology and the
+    parameters are part of the key : cached coordinates on
+    which the current node sizes overlap are spread by
+    overlapRemovalMethod, the cache keeping them unchanged.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+    method : str
+        the name of the layout plugin, e.g. 'FM^3 (OGDF)'
+    params : dict
+        the parameters changed from the plugin defaults
+    cacheDirectory : str
+        layoutCacheDirectory if None
+
+    Returns
+    -------
+    str
+        'cached', 'refined' or 'computed'
+    """
+    params = params or {}
+    filename = getCacheFilename(method, params,
+                                cacheDirectory or layoutCacheDirectory)
+    labels = getNodeLabels(graph)
+    topologyKey = getTopologyKey(graph, labels)
+    layouts = loadLayouts(filename)
+    if topologyKey in layouts:
+        setPositions(graph, labels, layouts[topologyKey])
+        status = 'cached'
+    else:
+        closestKey, shared = getClosestLayout(layouts, labels)
+        if closestKey is not None and shared >= warmStartRatio * len(labels):
+            setPositions(graph, labels, layouts[closestKey])
+            refineLayout(graph)
+            status = 'refined'
+        else:
+            pluginParams = tlp.getDefaultPluginParameters(method, graph)
+            for name, value in params.items():
+                pluginParams[name] = value
+            graph.applyLayoutAlgorithm(method, pluginParams)
+            status = 'computed'
+    # saved before the overlaps of the current sizes are removed
+    positions = getPositions(graph, labels)
+    if status != 'computed' and hasOverlaps(graph):
+        graph.applyLayoutAlgorithm(overlapRemovalMethod,
+                                   tlp.getDefaultPluginParameters(overlapRemovalMethod, graph))
+    # the most recently used layout goes last
+    layouts.pop(topologyKey, None)
+    layouts[topologyKey] = positions
+    saveLayouts(filename, layouts)
+    return status
@@ -0,0 +1,209 @@
+"""
+This library is dedicated to offline BioCyc queries, answered
+from local flat files or XML dumps indexed in SQLite.
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import sqlite3
+from xml.etree import ElementTree as ET
+from handle_requests import BiocycNotFoundError
+
+def readFlatFile(filename, attributes):
+    """
+    Reads the records of a BioCyc attribute-value flat file,
+    such as reactions.dat or pathways.dat.
+
+    Parameters
+    ----------
+    filename: str
+    attributes: list
+        the attributes to keep, e.g. ['IN-PATHWAY']
+
+    Yields
+    ------
+    uniqueId: str
+        the frame id of the record
+    record: dict
+        attribute as key and list of values as value
+    """
+    uniqueId, record = None, {a: [] for a in attributes}
+    with open(filename, encoding = 'latin-1') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                continue
+            if line == '//':
+                if uniqueId is not None:
+                    yield uniqueId, record
+                uniqueId, record = None, {a: [] for a in attributes}
+                continue
+            attribute, separator, value = line.partition(' - ')
+            if attribute == 'UNIQUE-ID':
+                uniqueId = value
+            elif attribute in record:
+                record[attribute].append(value)
+    if uniqueId is not None:
+        yield uniqueId, record
+
+def readXMLBundle(filename):
+    """
+    Reads the Reaction and Pathway frames of a BioCyc XML
+    export, which may hold one or many frames. Frames are
+    parsed incrementally and cleared once read.
+
+    Parameters
+    ----------
+    filename: str
+
+    Yields
+    ------
+    frameId: str
+    frameType: str
+        'Reaction' or 'Pathway'
+    linkedIds: list
+        the pathways of a reaction, or the reactions
+        of a pathway
+    """
+    paths = {'Reaction': './/in-pathway/Pathway',
+             'Pathway': './/reaction-list/Reaction'}
+    depth = 0
+    for event, e in ET.iterparse(filename, events = ('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        # frames are the children of <ptools-xml>
+        if depth == 1 and e.tag in paths and 'frameid' in e.attrib:
+            linkedIds = [l.attrib['frameid'] for l in e.findall(paths[e.tag])]
+            yield e.attrib['frameid'], e.tag, linkedIds
+        if depth <= 1:
+            e.clear()
+
+def buildOfflineStore(storeFilename, reactionsFilename = None,
+                      pathwaysFilename = None, xmlFilenames = ()):
+    """
+    Builds the SQLite store used by OfflineBiocyc from
+    BioCyc flat files and/or XML exports. The store is
+    built from scratch.
+
+    Parameters
+    ----------
+    storeFilename: str
+    reactionsFilename: str
+        the reactions.dat flat file
+    pathwaysFilename: str
+        the pathways.dat flat file
+    xmlFilenames: list
+        the BioCyc XML exports
+    """
+    connection = sqlite3.connect(storeFilename)
+    connection.executescript("""
+        DROP TABLE IF EXISTS frames;
+        DROP TABLE IF EXISTS links;
+        CREATE TABLE frames (frameid TEXT NOT NULL,
+                             type TEXT NOT NULL,
+                             PRIMARY KEY (frameid, type));
+        CREATE TABLE links (frameid TEXT NOT NULL,
+                            type TEXT NOT NULL,
+                            linkedid TEXT NOT NULL);""")
+    def addFrame(frameId, frameType, linkedIds):
+        connection.execute("INSERT OR IGNORE INTO frames VALUES (?, ?)",
+                           (frameId, frameType))
+        connection.executemany("INSERT INTO links VALUES (?, ?, ?)",
+                               [(frameId, frameType, l) for l in linkedIds])
+    if reactionsFilename is not None:
+        for frameId, record in readFlatFile(reactionsFilename, ['IN-PATHWAY']):
+            addFrame(frameId, 'Reaction', record['IN-PATHWAY'])
+    if pathwaysFilename is not None:
+        for frameId, record in readFlatFile(pathwaysFilename, ['REACTION-LIST']):
+            addFrame(frameId, 'Pathway', record['REACTION-LIST'])
+    for xmlFilename in xmlFilenames:
+        for frameId, frameType, linkedIds in readXMLBundle(xmlFilename):
+            addFrame(frameId, frameType, linkedIds)
+    connection.execute("CREATE INDEX links_frame ON links (frameid, type)")
+    connection.commit()
+    connection.close()
+
+class OfflineBiocyc:
+    """
+    Answers BioCyc queries from a store built with
+    buildOfflineStore(). Its methods can replace the web
+    lookups of handle_requests.PathwayIndex.
+
+    Parameters
+    ----------
+    storeFilename: str
+    """
+
+    def __init__(self, storeFilename):
+        self.connection = sqlite3.connect(storeFilename)
+
+    def getLinkedIds(self, frameId, frameType):
+        """
+        Return the ids linked to a frame.
+
+        Parameters
+        ----------
+        frameId: str
+        frameType: str
+            'Reaction' or 'Pathway'
+
+        Returns
+        -------
+        linkedIds: list
+
+        Raises
+        ------
+        BiocycNotFoundError
+            if the frame is not in the store
+        """
+        found = self.connection.execute(
+            "SELECT 1 FROM frames WHERE frameid = ? AND type = ?",
+            (frameId, frameType)).fetchone()
+        if found is None:
+            raise BiocycNotFoundError(f"{frameId} not found in the offline store")
+        rows = self.connection.execute(
+            """SELECT linkedid FROM links WHERE frameid = ? AND type = ?
+               ORDER BY rowid""", (frameId, frameType))
+        linkedIds = list(dict.fromkeys(row[0] for row in rows))
+        return linkedIds
+
+    def getReactionPathwayIds(self, reaction):
+        """
+        Same as handle_requests.getReactionPathwayIds().
+
+        Parameters
+        ----------
+        reaction: str
+
+        Returns
+        -------
+        pathways: list
+        """
+        return self.getLinkedIds(reaction, 'Reaction')
+
+    def getReactionIdsFromPathway(self, pathway):
+        """
+        Same as handle_requests.getReactionIdsFromPathway().
+
+        Parameters
+        ----------
+        pathway: str
+
+        Returns
+        -------
+        reactions: list
+        """
+        return self.getLinkedIds(pathway, 'Pathway')
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        self.connection.close()
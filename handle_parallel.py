@@ -0,0 +1,171 @@
+"""
+This library is dedicated to the aggregation of expression
+matrices across a pool of processes. The matrix is shared
+with the workers through a memory map or shared memory,
+never pickled.
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from scipy import sparse
+from aggregate_data import getSparseAggregate
+
+chunkSize = 1024 # groups aggregated per task
+
+class SharedMatrix:
+    """
+    A read-only matrix the workers can attach to. A matrix
+    backed by a file (e.g. from the expression cache) is
+    memory-mapped again by the workers, any other matrix is
+    copied once in shared memory.
+
+    Parameters
+    ----------
+    matrix: numpy array
+    """
+
+    def __init__(self, matrix):
+        self.memory = None
+        # a view of a memory map does not start at its offset
+        if (isinstance(matrix, np.memmap) and matrix.filename is not None
+                and isinstance(matrix.base, mmap.mmap)):
+            self.descriptor = ('memmap', matrix.filename, matrix.offset,
+                               matrix.shape, matrix.dtype.str)
+            return
+        self.memory = shared_memory.SharedMemory(create = True,
+                                                 size = max(1, matrix.nbytes))
+        copy = np.ndarray(matrix.shape, dtype = matrix.dtype,
+                          buffer = self.memory.buf)
+        copy[:] = matrix
+        self.descriptor = ('shm', self.memory.name, 0,
+                           matrix.shape, matrix.dtype.str)
+
+    def close(self):
+        """
+        Release the shared memory, if any.
+        """
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+def attachMatrix(descriptor):
+    """
+    Return the matrix described by SharedMatrix.descriptor,
+    without copying it.
+
+    Parameters
+    ----------
+    descriptor: tuple
+        (kind, name, offset, shape, dtype)
+
+    Returns
+    -------
+    matrix: numpy array
+        read-only
+    memory: shared_memory.SharedMemory
+        to keep alive as long as the matrix, or None
+    """
+    kind, name, offset, shape, dtype = descriptor
+    if kind == 'memmap':
+        matrix = np.memmap(name, dtype = dtype, mode = 'r',
+                           offset = offset, shape = tuple(shape))
+        return matrix, None
+    memory = shared_memory.SharedMemory(name = name)
+    matrix = np.ndarray(shape, dtype = dtype, buffer = memory.buf)
+    matrix.flags.writeable = False
+    return matrix, memory
+
+# the matrix of a worker process, set by initWorker()
+workerMatrix = None
+workerMemory = None
+# the read-only data sent once to each worker, if any
+workerState = None
+
+def initWorker(descriptor, state = None):
+    """
+    Attach a worker process to the shared matrix.
+
+    Parameters
+    ----------
+    descriptor: tuple
+    state: object
+        data used by every task of the worker
+    """
+    global workerMatrix, workerMemory, workerState
+    workerMatrix, workerMemory = attachMatrix(descriptor)
+    workerState = state
+
+def aggregateChunk(indptr, indices, method):
+    """
+    Aggregate a chunk of groups in a worker process. Only the
+    matrix rows used by the chunk are read.
+
+    Parameters
+    ----------
+    indptr: numpy array
+    indices: numpy array
+        the CSR arrays of the chunk incidence matrix
+    method: str
+
+    Returns
+    -------
+    numpy array
+        groups x timestamps
+    """
+    rows = np.unique(indices)
+    # the members keep their order, only their index changes
+    incidence = sparse.csr_matrix((np.ones(len(indices)),
+                                   np.searchsorted(rows, indices), indptr),
+                                  shape = (len(indptr) - 1, len(rows)))
+    return getSparseAggregate(incidence, np.asarray(workerMatrix[rows]), method)
+
+def getParallelSparseAggregate(incidence, matrix, method, processes = None):
+    """
+    Same as aggregate_data.getSparseAggregate(), with the
+    groups split into chunks aggregated by a process pool.
+
+    Parameters
+    ----------
+    incidence: scipy.sparse.csr_matrix
+        groups x rows incidence matrix
+    matrix: numpy array
+        rows x timestamps
+    method: str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    processes: int
+        the number of worker processes, all the CPUs if None
+
+    Returns
+    -------
+    numpy array
+        groups x timestamps
+    """
+    processes = processes or os.cpu_count()
+    nGroups = incidence.shape[0]
+    starts = range(0, nGroups, chunkSize)
+    sharedMatrix = SharedMatrix(matrix)
+    try:
+        with ProcessPoolExecutor(max_workers = processes, initializer = initWorker,
+                                 initargs = (sharedMatrix.descriptor,)) as executor:
+            futures = []
+            for start in starts:
+                chunk = incidence[start:start + chunkSize]
+                futures.append(executor.submit(aggregateChunk, chunk.indptr,
+                                               chunk.indices, method))
+            chunks = [future.result() for future in futures]
+    finally:
+        sharedMatrix.close()
+    if len(chunks) == 0:
+        return np.empty((0, matrix.shape[1]), dtype = matrix.dtype)
+    return np.vstack(chunks)
@@ -9,9 +9,19 @@ This library is dedicated to handling pathways data.
 @ SIMON Arnaud
 """
 
+import math
+import numpy as np
 import handle_graphs as hg
+import handle_layout
 from tulip import tlp
-from aggregate_data import getDataFrameAggregate
+from scipy import sparse
+try:
+    from tulipgui import tlpgui
+except ImportError:
+    # outside of the Tulip GUI : no view to open or check
+    tlpgui = None
+from aggregate_data import (SegmentAggregator, getDataFrameAggregate, getSegmentAggregate,
+                            getSparseAggregate)
 
 forceLayoutMethod = 'FM^3 (OGDF)'
 
@@ -51,6 +61,256 @@ def drawPathwaySubGraphs(graph, pathwayIdsToReactions):
         pathwayNodes = getPathwayNodes(graph, pathwayId, pathwayIdsToReactions)
         graph.inducedSubGraph(pathwayNodes, name = pathwayId)
 
+def getPathwayNodeIds(graph, pathwayIdsToReactions):
+    """
+    Return the ids of the nodes involved in each pathway
+    (reaction, substrate, and product), as getPathwayNodes()
+    with a single pass over the nodes of the graph.
+
+    Parameters
+    ----------
+    graph: tlp.Graph
+    pathwayIdsToReactions: dict
+        pathwayId as key and reactions as values
+
+    Returns
+    -------
+    pathwayIdToNodeIds: dict
+        pathwayId as key and the set of node ids (int) as value
+    """
+    ids = graph.getStringProperty('id')
+    idToNodes = {}
+    for n in graph.getNodes():
+        idToNodes.setdefault(ids[n], []).append(n)
+    pathwayIdToNodeIds = {}
+    for pathwayId, reactions in pathwayIdsToReactions.items():
+        nodeIds = set()
+        for reactionId in set(reactions):
+            for n in idToNodes.get(reactionId, []):
+                nodeIds.add(n.id)
+                nodeIds.update(m.id for m in graph.getInOutNodes(n))
+        pathwayIdToNodeIds[pathwayId] = frozenset(nodeIds)
+    return pathwayIdToNodeIds
+
+def isViewed(graph):
+    """
+    Check whether a graph is displayed in a view of the
+    Tulip GUI.
+
+    Parameters
+    ----------
+    graph: tlp.Graph
+
+    Returns
+    -------
+    boolean
+        False outside of the Tulip GUI
+    """
+    return tlpgui is not None and len(tlpgui.getViewsOfGraph(graph)) > 0
+
+class PathwayRegistry:
+    """
+    The pathways of a graph, kept as sets of node ids. The
+    subgraph of a pathway is only created when it is requested
+    with getSubGraph(), or opened from the quotient graph with
+    openSelectedPathways(). Beyond maxSubGraphs, the least
+    recently requested subgraphs created by the registry are
+    deleted, except the ones displayed in a view.
+
+    Parameters
+    ----------
+    graph: tlp.Graph
+    pathwayIdsToReactions: dict
+        pathwayId as key and reactions as values
+    maxSubGraphs: int
+        the number of subgraphs kept (at least 1),
+        no limit if None
+    """
+
+    def __init__(self, graph, pathwayIdsToReactions, maxSubGraphs = None):
+        self.graph = graph
+        self.maxSubGraphs = maxSubGraphs
+        self.pathwayIdToNodeIds = getPathwayNodeIds(graph, pathwayIdsToReactions)
+        # the subgraphs created by the registry, pathwayId as
+        # key, least recently requested first
+        self.subGraphs = {}
+        # created by getQuotientGraph()
+        self.quotientGraph = None
+
+    def __contains__(self, pathwayId):
+        return pathwayId in self.pathwayIdToNodeIds
+
+    def __len__(self):
+        return len(self.pathwayIdToNodeIds)
+
+    def getPathwayIds(self):
+        """
+        Return the ids of the pathways.
+
+        Returns
+        -------
+        list
+        """
+        return list(self.pathwayIdToNodeIds)
+
+    def getNodes(self, pathwayId):
+        """
+        Return the nodes involved in a pathway.
+
+        Parameters
+        ----------
+        pathwayId: str
+
+        Returns
+        -------
+        list
+            the list of tlp.node
+        """
+        return [tlp.node(i) for i in sorted(self.pathwayIdToNodeIds[pathwayId])]
+
+    def createSubGraph(self, pathwayId):
+        """
+        Return the subgraph of a pathway, created if needed,
+        without deleting any other. A subgraph of graph with
+        the pathwayId as name is used as is, and never deleted
+        by the registry.
+
+        Parameters
+        ----------
+        pathwayId: str
+
+        Returns
+        -------
+        tlp.Graph
+        """
+        subGraph = self.subGraphs.pop(pathwayId, None)
+        if subGraph is None:
+            existing = self.graph.getSubGraph(pathwayId)
+            if existing is not None:
+                return existing
+            subGraph = self.graph.inducedSubGraph(self.getNodes(pathwayId), name = pathwayId)
+        self.subGraphs[pathwayId] = subGraph
+        return subGraph
+
+    def getSubGraph(self, pathwayId):
+        """
+        Return the subgraph of a pathway, created if needed.
+        See createSubGraph() and evictSubGraphs().
+
+        Parameters
+        ----------
+        pathwayId: str
+
+        Returns
+        -------
+        tlp.Graph
+        """
+        subGraph = self.createSubGraph(pathwayId)
+        self.evictSubGraphs(kept = [pathwayId])
+        return subGraph
+
+    def evictSubGraphs(self, kept = ()):
+        """
+        Delete the least recently requested subgraphs until
+        maxSubGraphs are left, skipping the ones displayed in
+        a view : there may be more left.
+
+        Parameters
+        ----------
+        kept: list
+            pathwayIds whose subgraphs are not deleted
+        """
+        if self.maxSubGraphs is None:
+            return
+        for pathwayId in list(self.subGraphs):
+            if len(self.subGraphs) <= max(1, self.maxSubGraphs):
+                break
+            if pathwayId not in kept and not isViewed(self.subGraphs[pathwayId]):
+                self.releaseSubGraph(pathwayId)
+
+    def releaseSubGraph(self, pathwayId):
+        """
+        Delete the subgraph of a pathway, if created by the
+        registry. The pathway can still be requested.
+
+        Parameters
+        ----------
+        pathwayId: str
+        """
+        subGraph = self.subGraphs.pop(pathwayId, None)
+        if subGraph is not None:
+            self.graph.delSubGraph(subGraph)
+
+    def openSelectedPathways(self, nodes = None):
+        """
+        Open the pathways of quotient graph nodes : their
+        subgraphs are created if needed, and displayed in a
+        node-link view when run from the Tulip GUI.
+
+        Parameters
+        ----------
+        nodes: list
+            nodes of the quotient graph, the selected ones
+            (viewSelection) if None
+
+        Returns
+        -------
+        subGraphs: list
+            the tlp.Graph of the pathways
+        """
+        qg = self.quotientGraph
+        if nodes is None:
+            nodes = [n for n in qg.getNodes() if qg['viewSelection'][n]]
+        pathwayIds = [qg['pathwayId'][n] for n in nodes]
+        subGraphs = []
+        for pathwayId in pathwayIds:
+            subGraph = self.createSubGraph(pathwayId)
+            if tlpgui is not None and not isViewed(subGraph):
+                tlpgui.createNodeLinkDiagramView(subGraph)
+            subGraphs.append(subGraph)
+        self.evictSubGraphs(kept = pathwayIds)
+        return subGraphs
+
+    def getQuotientGraph(self, quotientGraphName = 'quotient graph'):
+        """
+        Create the quotient graph of the pathways without
+        their subgraphs : a node labelled with each pathwayId,
+        also kept in its 'pathwayId' property, and an edge
+        between two pathways when an edge of the graph goes
+        from a node of the first to a node of the second.
+        Select nodes, then openSelectedPathways() to open them.
+
+        Parameters
+        ----------
+        quotientGraphName: str
+
+        Returns
+        -------
+        qg: tlp.Graph
+        """
+        pathwayIds = self.getPathwayIds()
+        nodeIdToPathways = {}
+        for i, pathwayId in enumerate(pathwayIds):
+            for nodeId in self.pathwayIdToNodeIds[pathwayId]:
+                nodeIdToPathways.setdefault(nodeId, []).append(i)
+        pairs = set()
+        for e in self.graph.getEdges():
+            sources = nodeIdToPathways.get(self.graph.source(e).id, [])
+            targets = nodeIdToPathways.get(self.graph.target(e).id, [])
+            pairs.update((a, b) for a in sources for b in targets if a != b)
+        qg = hg.getRootGraph().addSubGraph(quotientGraphName)
+        nodePathwayIds = qg.getLocalStringProperty('pathwayId')
+        metaNodes = []
+        for pathwayId in pathwayIds:
+            n = qg.addNode()
+            qg['viewLabel'][n] = pathwayId
+            nodePathwayIds[n] = pathwayId
+            metaNodes.append(n)
+        for a, b in sorted(pairs):
+            qg.addEdge(metaNodes[a], metaNodes[b])
+        self.quotientGraph = qg
+        return qg
+
 def getOnePathwayExpression(pathwaySubGraph, method):
     """
     Return aggregated expression of a pathway from
@@ -64,19 +324,46 @@ def getOnePathwayExpression(pathwaySubGraph, method):
     Returns
     -------
     list
+        NaN where no reaction was measured
     """
     reactionsExpression = hg.getExpression(pathwaySubGraph)
-    # erreur avec minStd et maxStd quand les expressions de reactions n'ont pas ete mesurees
-    if len(reactionsExpression)==0:
-        return []
     return getDataFrameAggregate(reactionsExpression, method).to_list()
 
+def getStackedExpression(graphs):
+    """
+    Stack the expression values of the nodes of each graph.
+
+    Parameters
+    ----------
+    graphs : list
+        the tlp.Graph to stack
+
+    Returns
+    -------
+    values : numpy array
+        nodes x timestamps
+    offsets : numpy array
+        the first row of each graph, followed by the
+        number of rows
+    """
+    rows, offsets = [], [0]
+    for graph in graphs:
+        expression = graph['expression']
+        rows.extend(expression[n] for n in graph.getNodes())
+        offsets.append(len(rows))
+    # all the expression vectors have the timestamps of the dataset
+    values = np.array(rows, dtype = 'float64')
+    if len(rows) == 0:
+        values = values.reshape(0, 0)
+    return values, np.array(offsets)
+
 def getAllPathwaysExpression(graph, method):
     """
     Return Dictionary with pathway as keys and list of 
     aggregated expressions as values(computed from expression
     of involved reactions). The expression is computed from
-    sub-graphs each corresponding to independent pathways
+    sub-graphs each corresponding to independent pathways,
+    all aggregated at once.
     
     Parameters
     ----------
@@ -87,13 +374,134 @@ def getAllPathwaysExpression(graph, method):
     Returns
     -------
     pathwayIdToExpression: dict
+        NaN where no reaction of the pathway was measured
+    """
+    pathwaySubGraphs = list(graph.getSubGraphs())
+    values, offsets = getStackedExpression(pathwaySubGraphs)
+    expression = getSegmentAggregate(values, offsets, method).tolist()
+    pathwayIds = [pathwaySubGraph.getName() for pathwaySubGraph in pathwaySubGraphs]
+    return dict(zip(pathwayIds, expression))
+
+def getPathwayReactionMatrix(pathwayIdToReactions, reactionIds):
+    """
+    Return the sparse pathways x reactions membership matrix,
+    the reactions of a pathway keeping their order. Reactions
+    missing from reactionIds are left out.
+
+    Parameters
+    ----------
+    pathwayIdToReactions : dict
+        pathwayId as key and reactions as values
+    reactionIds : list
+        the reaction of each matrix column
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    """
+    reactionIndex = {r: i for i, r in enumerate(reactionIds)}
+    indptr, indices = [0], []
+    for reactions in pathwayIdToReactions.values():
+        indices.extend(reactionIndex[r] for r in dict.fromkeys(reactions) if r in reactionIndex)
+        indptr.append(len(indices))
+    # built from its arrays to keep the reactions order
+    return sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                             shape = (len(pathwayIdToReactions), len(reactionIds)))
+
+def getAllPathwaysExpressionFromReactions(pathwayIdToReactions, reactionIdToExpression,
+                                          method):
+    """
+    Same as getAllPathwaysExpression(), computed straight from
+    the reactions expression : all the pathways are aggregated
+    at once over the pathways x reactions matrix, without the
+    pathway sub-graphs.
+
+    Parameters
+    ----------
+    pathwayIdToReactions : dict
+        pathwayId as key and reactions as values
+    reactionIdToExpression : dict
+        reactionId as key and aggregated expression as value,
+        see handle_reactions.getAllReactionsExpression()
+    method : str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ']
+
+    Returns
+    -------
+    pathwayIdToExpression: dict
+        NaN where no reaction of the pathway was measured
+    """
+    reactionIds = list(reactionIdToExpression)
+    matrix = np.array([reactionIdToExpression[r] for r in reactionIds], dtype = 'float64')
+    if len(reactionIds) == 0:
+        matrix = matrix.reshape(0, 0)
+    incidence = getPathwayReactionMatrix(pathwayIdToReactions, reactionIds)
+    expression = getSparseAggregate(incidence, matrix, method).tolist()
+    return dict(zip(pathwayIdToReactions, expression))
+
+class PathwayExpressionUpdater:
     """
-    pathwayIdToExpression = {}
-    for pathwaySubGraph in graph.getSubGraphs():
-        pathwayName = pathwaySubGraph.getName()
-        pathwayExpression = getOnePathwayExpression(pathwaySubGraph, method)
-        pathwayIdToExpression[pathwayName] = pathwayExpression
-    return pathwayIdToExpression
+    Keeps the aggregated expression of pathways up to date
+    while timestamps are appended to the dataset, from the
+    reactions of a handle_reactions.ReactionExpressionUpdater.
+    Only the new timestamps are aggregated, except for the
+    pathways with a reaction whose earlier timestamps changed.
+
+    Parameters
+    ----------
+    pathwayIdToReactions : dict
+        pathwayId as key and reactions as values
+    reactionUpdater : handle_reactions.ReactionExpressionUpdater
+    method : str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ']
+    """
+
+    def __init__(self, pathwayIdToReactions, reactionUpdater, method):
+        self.reactionUpdater = reactionUpdater
+        self.pathwayIds = list(pathwayIdToReactions)
+        incidence = getPathwayReactionMatrix(pathwayIdToReactions,
+                                             reactionUpdater.reactionIds)
+        self.memberReactions = incidence.indices
+        self.aggregator = SegmentAggregator(incidence.indptr, method)
+        self.update(np.zeros(len(reactionUpdater.reactionIds), dtype = bool))
+
+    def update(self, changedReactions):
+        """
+        Aggregate the timestamps added to the reactions since
+        the last update.
+
+        Parameters
+        ----------
+        changedReactions : numpy array
+            returned by the reactionUpdater.update()
+
+        Returns
+        -------
+        changed : numpy array
+            True for the pathways whose earlier timestamps
+            changed, the new ones being always computed
+        """
+        nPrevious = self.aggregator.result.nColumns
+        newValues = self.reactionUpdater.getExpressionRows(self.memberReactions, nPrevious)
+        changed = self.aggregator.append(newValues)
+        isKnown = self.memberReactions >= 0
+        isChanged = np.zeros(len(self.memberReactions), dtype = bool)
+        isChanged[isKnown] = changedReactions[self.memberReactions[isKnown]]
+        members = np.flatnonzero(isChanged)
+        if len(members) > 0:
+            values = self.reactionUpdater.getExpressionRows(self.memberReactions[members])
+            changed |= self.aggregator.replace(members, values)
+        return changed
+
+    def getPathwaysExpression(self):
+        """
+        Same as getAllPathwaysExpressionFromReactions().
+
+        Returns
+        -------
+        pathwayIdToExpression : dict
+        """
+        return dict(zip(self.pathwayIds, self.aggregator.result.values.tolist()))
 
 def setPathwayExpressionProperty(quotientGraph, pathwaysExpression):
     """
@@ -112,58 +520,127 @@ def setPathwayExpressionProperty(quotientGraph, pathwaysExpression):
         pathwayLabel = quotientGraph['viewLabel'][n]
         quotientGraph['expression'][n] = pathwaysExpression[pathwayLabel]
 
-def customizeGraph(graph):
+def getTimestampPropertyName(timestamp, name):
     """
-    Adapt size and color of graph' nodes depending on expression
-    level at timestamp
+    Return the name of a property of a timestamp.
 
     Parameters
     ----------
-    graph : tlp.Graph
+    timestamp : int
+    name : str
+        'expression', 'size' or 'color'
+
+    Returns
+    -------
+    str
     """
-    for n in graph.getNodes():
-        pathwayExpression = graph['expression'][n]
-        # do not display pathways without measured expression :
-        if len(pathwayExpression) == 0:
-            graph['viewSize'][n] = (0, 0, 0)
-        else:
-            tpExpression = graph['tpExpression'][n]
-            size = abs(tpExpression)*200
-            graph['viewSize'][n] = (size, size, 0)
-        graph['viewShape'][n] = tlp.NodeShape.Circle
-    hg.colorNodes(graph, 'tpExpression')
-    graph.applyLayoutAlgorithm(forceLayoutMethod)
+    return f'tp{timestamp+1} {name}'
 
-def setTimestampExpressionProperty(quotientGraph, timestamp):
+def setTimestampProperties(quotientGraph, timestamp):
     """
-    Adds or updates the tpExpression property of a graph.
-    It corresponds to the expression at a given timestamp.
+    Adds or updates the properties of a timestamp : the
+    expression at this timestamp, and the size and color of
+    the nodes depending on it. They are displayed by
+    showTimestamp().
 
     Parameters
     ----------
-    quotientGraph : objet tlp.Graph
+    quotientGraph : tlp.Graph
     timestamp : int
     """
-    quotientGraph.getDoubleProperty('tpExpression')
+    expressionName = getTimestampPropertyName(timestamp, 'expression')
+    tpExpression = quotientGraph.getDoubleProperty(expressionName)
+    tpSize = quotientGraph.getSizeProperty(getTimestampPropertyName(timestamp, 'size'))
     for n in quotientGraph.getNodes():
-        pathwayExpression = quotientGraph['expression'][n]
-        # ignore pathways without measured gene activity
-        if len(pathwayExpression) > 0:
-            quotientGraph['tpExpression'][n] = pathwayExpression[timestamp]
+        value = quotientGraph['expression'][n][timestamp]
+        # pathways without measured gene activity get a null size
+        if math.isnan(value):
+            value = 0
+        tpExpression[n] = value
+        size = abs(value)*200
+        tpSize[n] = (size, size, 0)
+    hg.colorNodes(quotientGraph, expressionName,
+                  colorPropertyName = getTimestampPropertyName(timestamp, 'color'))
 
-def drawQuotientGraphs(graph, pathwaysExpression, timestamps):
+def addTimestamps(quotientGraph, pathwaysExpression, timestamps):
     """
-    Draw Quotient Graph of pathways for each timestamp
+    Adds or updates the properties of timestamps.
 
     Parameters
     ----------
-    graph : tlp.Graph
+    quotientGraph : tlp.Graph
+    pathwaysExpression : dict
+        pathwayId as key and aggregated expression as value
     timestamps : list
         the list of timestamps (int)
     """
+    setPathwayExpressionProperty(quotientGraph, pathwaysExpression)
     for t in timestamps:
-        quotientGraphName = f'tp{t+1} quotient graph'
+        setTimestampProperties(quotientGraph, t)
+
+def showTimestamp(quotientGraph, timestamp):
+    """
+    Display the expression of pathways at a timestamp : only
+    the tpExpression, viewSize and viewColor values are
+    swapped, the layout is kept.
+
+    Parameters
+    ----------
+    quotientGraph : tlp.Graph
+    timestamp : int
+    """
+    quotientGraph.getDoubleProperty('tpExpression').copy(
+        quotientGraph[getTimestampPropertyName(timestamp, 'expression')])
+    quotientGraph['viewSize'].copy(quotientGraph[getTimestampPropertyName(timestamp, 'size')])
+    quotientGraph['viewColor'].copy(quotientGraph[getTimestampPropertyName(timestamp, 'color')])
+
+def layoutQuotientGraph(quotientGraph, timestamps):
+    """
+    Apply the force layout once for all the timestamps, each
+    node having its largest size. The coordinates are reused
+    from the layout cache when the pathways are unchanged.
+
+    Parameters
+    ----------
+    quotientGraph : tlp.Graph
+    timestamps : list
+        the list of timestamps (int)
+    """
+    tpSizes = [quotientGraph[getTimestampPropertyName(t, 'size')] for t in timestamps]
+    for n in quotientGraph.getNodes():
+        size = max(tpSize[n][0] for tpSize in tpSizes)
+        quotientGraph['viewSize'][n] = (size, size, 0)
+    handle_layout.applyCachedLayout(quotientGraph, forceLayoutMethod)
+
+def drawQuotientGraph(graph, pathwaysExpression, timestamps,
+                      quotientGraphName = 'quotient graph', pathwayRegistry = None):
+    """
+    Draw the Quotient Graph of pathways once, with the
+    properties of each timestamp. The first timestamp is
+    displayed, see showTimestamp() to display another one.
+
+    Parameters
+    ----------
+    graph : tlp.Graph
+    pathwaysExpression : dict
+        pathwayId as key and aggregated expression as value
+    timestamps : list
+        the list of timestamps (int)
+    quotientGraphName : str
+    pathwayRegistry : PathwayRegistry
+        the pathways, if they have no subgraph in graph
+
+    Returns
+    -------
+    qg : tlp.Graph
+    """
+    timestamps = list(timestamps)
+    if pathwayRegistry is None:
         qg = hg.getQuotientGraph(graph, quotientGraphName)
-        setPathwayExpressionProperty(qg, pathwaysExpression)
-        setTimestampExpressionProperty(qg, t)
-        customizeGraph(qg)
+    else:
+        qg = pathwayRegistry.getQuotientGraph(quotientGraphName)
+    addTimestamps(qg, pathwaysExpression, timestamps)
+    qg['viewShape'].setAllNodeValue(tlp.NodeShape.Circle)
+    layoutQuotientGraph(qg, timestamps)
+    showTimestamp(qg, timestamps[0])
+    return qg
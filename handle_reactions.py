@@ -9,15 +9,178 @@ Library to interact with reactions-level data.
 @ SIMON Arnaud
 """
 
+import re
+import weakref
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-from handle_genes import isGeneWithData, getGeneData
-from aggregate_data import getDataFrameAggregate, getDataFrameNormalZAggregate
+from scipy import sparse
+import handle_genes
+from handle_parallel import getParallelSparseAggregate
+from aggregate_data import SegmentAggregator, getSegmentAggregate, getSparseAggregate
 
-def parseGeneAssociation(graph):
+gprTokenPattern = re.compile(r"""\s*(?:([(\[{])|([)\]}])|(['"])(.*?)\3|([^\s()\[\]{}'"]+))""")
+# the words of a rule that does not parse, e.g. with an unbalanced quote
+gprWordPattern = re.compile(r"""[^\s()\[\]{}'"]+""")
+
+def tokenizeGPR(rule):
+    """
+    Split a gene-protein-reaction rule into tokens.
+
+    Parameters
+    ----------
+    rule: str
+        e.g. "('thrA') or ('metL' and 'thrB')"
+
+    Returns 
+    -------
+    tokens: list
+        '(', ')', 'and', 'or' or ('gene', name) tuples
+    """
+    tokens = []
+    position = 0
+    rule = rule.rstrip()
+    while position < len(rule):
+        match = gprTokenPattern.match(rule, position)
+        if match is None:
+            raise ValueError(f"invalid gene association: {rule!r}")
+        opening, closing, quote, quoted, word = match.groups()
+        if opening:
+            tokens.append('(')
+        elif closing:
+            tokens.append(')')
+        elif quote:
+            tokens.append(('gene', quoted))
+        elif word.lower() in ('and', 'or'):
+            tokens.append(word.lower())
+        else:
+            tokens.append(('gene', word))
+        position = match.end()
+    return tokens
+
+@lru_cache(maxsize = None)
+def parseGPR(rule):
+    """
+    Parse a gene-protein-reaction rule, 'and' binding tighter
+    than 'or'. Identical rules are parsed once.
+
+    Parameters
+    ----------
+    rule: str
+
+    Returns 
+    -------
+    tree: tuple
+        ('gene', name), ('and', children) or ('or', children),
+        None for an empty rule
+    """
+    tokens = tokenizeGPR(rule)
+    position = 0
+
+    def parseOperands(operator, parseOperand):
+        nonlocal position
+        operands = [parseOperand()]
+        while position < len(tokens) and tokens[position] == operator:
+            position += 1
+            operands.append(parseOperand())
+        return operands[0] if len(operands) == 1 else (operator, tuple(operands))
+
+    def parseOr():
+        return parseOperands('or', parseAnd)
+
+    def parseAnd():
+        return parseOperands('and', parseAtom)
+
+    def parseAtom():
+        nonlocal position
+        if position == len(tokens):
+            raise ValueError(f"invalid gene association: {rule!r}")
+        token = tokens[position]
+        position += 1
+        if token == '(':
+            tree = parseOr()
+            # a missing closing parenthesis is tolerated at the end
+            if position < len(tokens):
+                if tokens[position] != ')':
+                    raise ValueError(f"invalid gene association: {rule!r}")
+                position += 1
+            return tree
+        if isinstance(token, tuple):
+            return token
+        raise ValueError(f"invalid gene association: {rule!r}")
+
+    if len(tokens) == 0:
+        return None
+    tree = parseOr()
+    if position != len(tokens):
+        raise ValueError(f"invalid gene association: {rule!r}")
+    return tree
+
+@lru_cache(maxsize = None)
+def getGPRComplexes(rule):
+    """
+    Return the enzymes of a rule as alternative gene sets
+    (disjunctive normal form) : each set is a complex, and
+    any of them catalyses the reaction.
+
+    Parameters
+    ----------
+    rule: str
+
+    Returns 
+    -------
+    complexes: tuple
+        tuple of gene names tuples, the genes of a complex
+        in order of appearance
+    """
+    def expand(tree):
+        if tree[0] == 'gene':
+            return [(tree[1],)]
+        children = [expand(child) for child in tree[1]]
+        if tree[0] == 'or':
+            return [c for complexes in children for c in complexes]
+        complexes = [()]
+        for alternatives in children:
+            complexes = [tuple(dict.fromkeys(c + a)) for c in complexes for a in alternatives]
+        return complexes
+
+    tree = parseGPR(rule)
+    if tree is None:
+        return ()
+    # the same complex written twice is kept once
+    complexes = {}
+    for c in expand(tree):
+        complexes.setdefault(frozenset(c), c)
+    return tuple(complexes.values())
+
+@lru_cache(maxsize = None)
+def getGPRGenes(rule):
+    """
+    Return all the genes of the complexes of a rule. The
+    genes of a rule that does not parse are its words, other
+    than 'and' and 'or' : a malformed rule never raises.
+
+    Parameters
+    ----------
+    rule: str
+
+    Returns 
+    -------
+    genes: tuple
+    """
+    try:
+        complexes = getGPRComplexes(rule)
+    except ValueError:
+        complexes = [[word for word in gprWordPattern.findall(rule)
+                      if word.lower() not in ('and', 'or')]]
+    return tuple(dict.fromkeys(gene for genes in complexes for gene in genes))
+
+def getGeneAssociation(graph):
     """
     Return dictionary with the BioCyc ID of an element as key,
-    and the list of genes as value. The elements can be substrates,
-    products, or reactions. Only the genes with an expression are kept.
+    and the list of all its genes as value, measured or not.
+    The genes of 'and' complexes are all kept. It does not
+    depend on the expression dataset.
 
     Parameters
     ----------
@@ -30,13 +193,160 @@ def parseGeneAssociation(graph):
     biocycIdToGenes = {}
     for node in graph.getNodes():
         biocycId = graph['id'][node]
-        biocycIdToGenes[biocycId] = []
-        for mot in graph['geneAssociation'][node].split(' or '):
-            if isGeneWithData(mot[2:-2]):
-                biocycIdToGenes[biocycId].append(mot[2:-2])
+        rule = graph['geneAssociation'][node]
+        biocycIdToGenes[biocycId] = list(getGPRGenes(rule))
     return biocycIdToGenes
 
-def getReactionData(biocycId, biocycIdToGenes):
+def getAssociatedGenes(biocycIdToGenes):
+    """
+    Return all the genes associated to the graph elements,
+    to only load their expression data.
+
+    Parameters
+    ----------
+    biocycIdToGenes: dict
+        from getGeneAssociation()
+
+    Returns 
+    -------
+    genes: set
+    """
+    genes = set()
+    for geneNames in biocycIdToGenes.values():
+        genes.update(geneNames)
+    return genes
+
+def filterGeneAssociation(biocycIdToGenes, dataset = None):
+    """
+    Keep only the genes with an expression in a dataset.
+
+    Parameters
+    ----------
+    biocycIdToGenes: dict
+        from getGeneAssociation()
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+
+    Returns 
+    -------
+    dict
+    """
+    dataset = dataset or handle_genes.dataset
+    return {biocycId: dataset.filterGenesWithData(genes)
+            for biocycId, genes in biocycIdToGenes.items()}
+
+def parseGeneAssociation(graph, dataset = None):
+    """
+    Return dictionary with the BioCyc ID of an element as key,
+    and the list of genes as value. The elements can be substrates,
+    products, or reactions. Only the genes with an expression are kept.
+
+    Parameters
+    ----------
+    graph: tlp.Graph()
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+
+    Returns 
+    -------
+    biocycIdToGenes: dict
+    """
+    return filterGeneAssociation(getGeneAssociation(graph), dataset)
+
+class AggregateCache:
+    """
+    Aggregated expression values of one dataset, keyed by the
+    frozen gene set and the aggregation method. Reactions
+    catalysed by the same genes share one computed list,
+    which must not be modified.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+        self.nTimestamps = None
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key):
+        """
+        Return the aggregated values of a gene set.
+
+        Parameters
+        ----------
+        key: tuple
+            (frozenset of genes, method)
+
+        Returns
+        -------
+        list, or None if the gene set was not aggregated
+        """
+        expression = self.values.get(key)
+        if expression is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return expression
+
+    def put(self, key, expression):
+        """
+        Store the aggregated values of a gene set.
+
+        Parameters
+        ----------
+        key: tuple
+            (frozenset of genes, method)
+        expression: list
+        """
+        self.values[key] = expression
+
+    def clear(self):
+        """
+        Forget the stored values and reset the statistics.
+        """
+        self.values.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def getStats(self):
+        """
+        Returns
+        -------
+        stats: dict
+            the number of hits, misses and stored gene sets
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.values)}
+
+# one cache per dataset, dropped with the dataset
+aggregateCaches = weakref.WeakKeyDictionary()
+
+def getAggregateCache(dataset = None):
+    """
+    Return the aggregate cache of a dataset.
+
+    Parameters
+    ----------
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+
+    Returns
+    -------
+    AggregateCache
+    """
+    dataset = dataset or handle_genes.dataset
+    if dataset not in aggregateCaches:
+        aggregateCaches[dataset] = AggregateCache()
+    cache = aggregateCaches[dataset]
+    # the values are stale once timestamps are appended
+    if cache.nTimestamps != dataset.getTimestampCount():
+        cache.values.clear()
+        cache.nTimestamps = dataset.getTimestampCount()
+    return cache
+
+def getReactionData(biocycId, biocycIdToGenes, dataset = None):
     """
     Return expression data of the genes involved in a reaction.
     If biocycId = ID of a substrate, an empty dataframe
@@ -45,20 +355,23 @@ def getReactionData(biocycId, biocycIdToGenes):
     ----------
     biocycId: str
     biocycIdToGenes: dict
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
 
     Returns
     -------
     reactionData: pandas.DataFrame
     """
-    reactionData = {'level': {}, 'ratio': {}}
+    dataset = dataset or handle_genes.dataset
+    reactionData = {}
+    geneNames = list(dict.fromkeys(biocycIdToGenes[biocycId]))
     for dataType in ['level', 'ratio']:
-        for geneName in biocycIdToGenes[biocycId]:
-            geneData = getGeneData(geneName)
-            reactionData[dataType][geneName] = geneData[dataType][0]
-        reactionData[dataType] = pd.DataFrame.from_dict(reactionData[dataType], orient="index")
+        data = dataset.getGenesData(geneNames, dataType)
+        # wrap the dataset rows without another copy
+        reactionData[dataType] = pd.DataFrame(data, index = geneNames, copy = False)
     return reactionData
 
-def getReactionExpression(reactionId, reactionIdToGenes, method):
+def getReactionExpression(reactionId, reactionIdToGenes, method, dataset = None):
     """
     Aggregate expression values for a BioCyc element.
 
@@ -70,23 +383,122 @@ def getReactionExpression(reactionId, reactionIdToGenes, method):
         reactionId as key and genes as values
     method: str
         from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
     
     Returns
     -------
-    pandas.DataFrame
+    expression: list
+        shared by the reactions with the same genes,
+        NaN for substrates and products
+    """
+    dataset = dataset or handle_genes.dataset
+    if len(reactionIdToGenes[reactionId]) == 0:    # substract or product
+        return [np.nan] * dataset.getTimestampCount()
+    cache = getAggregateCache(dataset)
+    key = (frozenset(reactionIdToGenes[reactionId]), method)
+    expression = cache.get(key)
+    if expression is not None:
+        return expression
+    geneNames = list(dict.fromkeys(reactionIdToGenes[reactionId]))
+    dataType = 'level' if method == 'normalZ' else 'ratio'
+    values = dataset.getGenesData(geneNames, dataType)
+    expression = getSegmentAggregate(values, [0, len(values)], method)[0].tolist()
+    cache.put(key, expression)
+    return expression
+
+def getReactionGeneMatrix(reactionIds, reactionIdToGenes, dataset = None):
+    """
+    Return the sparse reactions x loci incidence matrix of
+    the genes involved in reactions. Its columns are the rows
+    of the dataset matrices.
+
+    Parameters
+    ----------
+    reactionIds: list
+    reactionIdToGenes: dict
+        reactionId as key and measured genes as values
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+    """
+    dataset = dataset or handle_genes.dataset
+    indptr, indices = [0], []
+    for reactionId in reactionIds:
+        geneNames = list(dict.fromkeys(reactionIdToGenes[reactionId]))
+        indices.extend(dataset.getGeneRows(geneNames))
+        indptr.append(len(indices))
+    # built from its arrays to keep the genes order
+    return sparse.csr_matrix((np.ones(len(indices)), indices, indptr),
+                             shape = (len(reactionIds), len(dataset.loci)))
+
+def getAllReactionsExpression(reactionIds, reactionIdToGenes, method, dataset = None,
+                              processes = 1):
+    """
+    Aggregate expression values of all BioCyc elements at once.
+    Same results as getReactionExpression() for each element.
+
+    Parameters
+    ----------
+    reactionIds: list
+        substrate, product, or reaction' IDs from BioCyc
+    reactionIdToGenes: dict 
+        reactionId as key and genes as values
+    method: str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+    processes: int
+        the number of processes aggregating the reactions,
+        all the CPUs if None
+
+    Returns
+    -------
+    reactionIdToExpression: dict
+        reactionId as key and aggregated expression (list)
+        as value, shared by the reactions with the same genes,
+        NaN for substrates and products
     """
-    nodeData = getReactionData(reactionId, reactionIdToGenes)
-    if len(nodeData['level']) == 0:    # substract or product
-        return []
-    if method=='normalZ':
-        return getDataFrameNormalZAggregate(nodeData['level']).tolist()
-    return getDataFrameAggregate(nodeData['ratio'], method).tolist()
+    dataset = dataset or handle_genes.dataset
+    cache = getAggregateCache(dataset)
+    reactionIdToKey = {}
+    geneSets = {}    # the gene sets to aggregate, in order of appearance
+    for reactionId in dict.fromkeys(reactionIds):
+        genes = reactionIdToGenes[reactionId]
+        key = (frozenset(genes), method)
+        reactionIdToKey[reactionId] = key
+        if len(genes) == 0:    # substract or product
+            continue
+        if key in geneSets:
+            cache.hits += 1
+        elif cache.get(key) is None:
+            geneSets[key] = genes
+    if len(geneSets) > 0:
+        keys = list(geneSets)
+        incidence = getReactionGeneMatrix(keys, geneSets, dataset)
+        matrix = dataset.levels if method == 'normalZ' else dataset.ratios
+        if processes == 1:
+            expression = getSparseAggregate(incidence, matrix, method)
+        else:
+            expression = getParallelSparseAggregate(incidence, matrix, method, processes)
+        for i, key in enumerate(keys):
+            cache.put(key, expression[i].tolist())
+    unmeasured = [np.nan] * dataset.getTimestampCount()
+    reactionIdToExpression = {}
+    for reactionId, key in reactionIdToKey.items():
+        reactionIdToExpression[reactionId] = cache.values.get(key, unmeasured)
+    return reactionIdToExpression
 
-def setReactionExpressionProperty(graph, reactionIdToGenes, method):
+def setReactionExpressionProperty(graph, reactionIdToGenes, method, dataset = None,
+                                  processes = 1):
     """
     Add or Update the 'expression' property of graph
     this property contain Expression' values after aggregation of
     BioCyc elements (reaction, substrate, or product).
+    All the elements are aggregated at once.
 
     Parameters
     ----------
@@ -95,8 +507,173 @@ def setReactionExpressionProperty(graph, reactionIdToGenes, method):
         reactionId as key and genes as values
     method: str
         from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+    processes: int
+        the number of processes aggregating the reactions,
+        all the CPUs if None
+
+    Returns
+    -------
+    reactionIdToExpression: dict
+        see getAllReactionsExpression()
     """
     graph.getDoubleVectorProperty('expression')
-    for node in graph.getNodes():
-        reactionId = graph['id'][node]
-        graph['expression'][node] = getReactionExpression(reactionId, reactionIdToGenes, method)
+    nodes = list(graph.getNodes())
+    reactionIds = [graph['id'][node] for node in nodes]
+    reactionIdToExpression = getAllReactionsExpression(reactionIds, reactionIdToGenes,
+                                                       method, dataset, processes)
+    for node, reactionId in zip(nodes, reactionIds):
+        graph['expression'][node] = reactionIdToExpression[reactionId]
+    return reactionIdToExpression
+
+class ReactionExpressionUpdater:
+    """
+    Keeps the aggregated expression of reactions up to date
+    while timestamps are appended to the dataset, see
+    ExpressionDataset.appendTimepoints(). Only the new
+    timestamps are aggregated, see
+    aggregate_data.SegmentAggregator.
+
+    Parameters
+    ----------
+    reactionIds: list
+        substrate, product, or reaction' IDs from BioCyc
+    reactionIdToGenes: dict 
+        reactionId as key and genes as values
+    method: str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+    """
+
+    def __init__(self, reactionIds, reactionIdToGenes, method, dataset = None):
+        self.dataset = dataset or handle_genes.dataset
+        self.method = method
+        self.reactionIds = list(dict.fromkeys(reactionIds))
+        self.reactionIndex = {r: i for i, r in enumerate(self.reactionIds)}
+        # the gene set of each reaction, -1 for substrates and products
+        self.reactionToSet = np.full(len(self.reactionIds), -1)
+        setIndex, geneSets = {}, []
+        for i, reactionId in enumerate(self.reactionIds):
+            genes = reactionIdToGenes[reactionId]
+            if len(genes) == 0:
+                continue
+            key = frozenset(genes)
+            if key not in setIndex:
+                setIndex[key] = len(geneSets)
+                geneSets.append(genes)
+            self.reactionToSet[i] = setIndex[key]
+        incidence = getReactionGeneMatrix(range(len(geneSets)), geneSets, self.dataset)
+        self.rows = incidence.indices
+        self.aggregator = SegmentAggregator(incidence.indptr, method)
+        self.update()
+
+    def getMatrix(self):
+        """
+        Return the matrix aggregated with the method.
+
+        Returns
+        -------
+        numpy array
+        """
+        if self.method == 'normalZ':
+            return self.dataset.levels
+        return self.dataset.ratios
+
+    def update(self):
+        """
+        Aggregate the timestamps appended to the dataset since
+        the last update.
+
+        Returns
+        -------
+        changed: numpy array
+            True for the reactions whose earlier timestamps
+            changed, the new ones being always computed
+        """
+        nPrevious = self.aggregator.result.nColumns
+        newColumns = self.getMatrix()[:, nPrevious:][self.rows]
+        changedSets = self.aggregator.append(newColumns)
+        changed = np.zeros(len(self.reactionIds), dtype = bool)
+        hasGenes = self.reactionToSet >= 0
+        changed[hasGenes] = changedSets[self.reactionToSet[hasGenes]]
+        return changed
+
+    def getTimestampCount(self):
+        """
+        Return the number of aggregated timestamps.
+
+        Returns
+        -------
+        int
+        """
+        return self.aggregator.result.nColumns
+
+    def getExpressionRows(self, reactionIndexes, start = 0):
+        """
+        Return the aggregated expression of reactions from a
+        timestamp, NaN for substrates, products, and unknown
+        reactions.
+
+        Parameters
+        ----------
+        reactionIndexes: numpy array
+            the reactions position in reactionIds, -1 for
+            unknown reactions
+        start: int
+            the first timestamp
+
+        Returns
+        -------
+        numpy array
+            reactions x timestamps
+        """
+        reactionIndexes = np.asarray(reactionIndexes, dtype = int)
+        setIndexes = np.full(len(reactionIndexes), -1)
+        isKnown = reactionIndexes >= 0
+        setIndexes[isKnown] = self.reactionToSet[reactionIndexes[isKnown]]
+        values = self.aggregator.result.values[:, start:]
+        rows = np.full((len(setIndexes), values.shape[1]), np.nan)
+        rows[setIndexes >= 0] = values[setIndexes[setIndexes >= 0]]
+        return rows
+
+    def getReactionsExpression(self):
+        """
+        Same as getAllReactionsExpression().
+
+        Returns
+        -------
+        reactionIdToExpression: dict
+            reactionId as key and aggregated expression (list)
+            as value, NaN for substrates and products
+        """
+        rows = self.getExpressionRows(np.arange(len(self.reactionIds)))
+        return dict(zip(self.reactionIds, rows.tolist()))
+
+def updateReactionExpressionProperty(graph, updater, changed, nPrevious):
+    """
+    Push the timestamps aggregated by updater.update() into
+    the 'expression' property of graph : new values are
+    appended, NaN for substrates and products, and the
+    reactions whose earlier timestamps changed are set again.
+
+    Parameters
+    ----------
+    graph: tlp.Graph
+    updater: ReactionExpressionUpdater
+    changed: numpy array
+        returned by updater.update()
+    nPrevious: int
+        the number of timestamps before the update
+    """
+    expression = graph.getDoubleVectorProperty('expression')
+    nodes = list(graph.getNodes())
+    reactionIndexes = [updater.reactionIndex.get(graph['id'][n], -1) for n in nodes]
+    newValues = updater.getExpressionRows(reactionIndexes, nPrevious)
+    for node, i, values in zip(nodes, reactionIndexes, newValues):
+        if i >= 0 and changed[i]:
+            expression[node] = updater.getExpressionRows([i])[0].tolist()
+        else:
+            for value in values:
+                expression.pushBackNodeEltValue(node, float(value))
@@ -9,11 +9,199 @@ This library is dedicated to BioCyc interactions.
 @ SIMON Arnaud
 """
 
+import io
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from xml.etree import ElementTree as ET
 import handle_graphs as hg
+from handle_fetch import FetchStats, ThrottledError, TransientError, fetchAll
 import time
 
+biocycURL = 'https://websvc.biocyc.org'
+organism = 'ECOLI'
+maxConcurrentRequests = 4
+maxRequestRate = 2.0 # requests per second
+requestTimeout = 5 # seconds
+# if True, each download is printed with its time since start
+logRequests = True
+start = time.time()
+# handle_cache.ResponseCache, set with setResponseCache()
+responseCache = None
+# requests.Session shared by all requests, see getSession()
+session = None
+
+class BiocycNotFoundError(LookupError):
+    """
+    Raised when an object is not found on BioCyc. Only this
+    error means that a reaction should be deleted.
+    """
+
+def setResponseCache(cache):
+    """
+    Set the cache used to store BioCyc responses on disk.
+    
+    Parameters
+    ----------
+    cache : handle_cache.ResponseCache
+        the response cache, or None to always query BioCyc
+    """
+    global responseCache
+    responseCache = cache
+
+def getSession():
+    """
+    Return the HTTP session shared by all BioCyc requests.
+    Its connections are kept alive and pooled, and failed
+    connections are retried with an exponential backoff. A
+    request is only sent once.
+    
+    Returns
+    -------
+    session : requests.Session
+    """
+    global session
+    if session is None:
+        # only the connections that could not be opened are
+        # retried here : timeouts and HTTP errors are retried by
+        # fetchAll(), which counts them and adapts the request rate
+        retries = Retry(total = 3, connect = 3, read = 0, status = 0, other = 0,
+                        backoff_factor = 0.5, allowed_methods = ['GET'],
+                        raise_on_status = False)
+        adapter = HTTPAdapter(pool_connections = 1,
+                              pool_maxsize = maxConcurrentRequests,
+                              max_retries = retries)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+def downloadBiocyc(ID):
+    """
+    Downloads an object (reaction, pathway ...) from BioCyc.
+    
+    Parameters
+    ----------
+    ID : string
+        the id of the requested object
+    
+    Returns
+    -------
+    status : int
+        the HTTP status code of the response, 200 or 404
+    content : bytes
+        the raw BioCyc XML of our requested object
+
+    Raises
+    ------
+    ThrottledError
+        if BioCyc asks to slow down (429, 503)
+    TransientError
+        if the request timed out or failed (5xx)
+    requests.HTTPError
+        for any other unexpected status code
+    """
+    # monitor requests 
+    URL = f"{biocycURL}/getxml?{organism}:" + ID
+    try:
+        response = getSession().get(URL, timeout = requestTimeout)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        raise TransientError(f"{ID}: {e}") from e
+    status = response.status_code
+    if logRequests:
+        print(f"{round(time.time() - start, 2)}: {ID} ({status})")
+    # in case of a temporary ban, let fetchAll() back off
+    if status in (429, 503):
+        retryAfter = response.headers.get('Retry-After')
+        if retryAfter is not None and retryAfter.isdigit():
+            retryAfter = float(retryAfter)
+        else:
+            retryAfter = None
+        raise ThrottledError(status, retryAfter)
+    if status >= 500:
+        raise TransientError(f"{ID}: server error ({status})")
+    if status not in (200, 404):
+        response.raise_for_status()
+    return status, response.content
+
+def extractFrameIds(source, path):
+    """
+    Extracts the frame ids of the elements matching a path
+    from a BioCyc XML document. The document is parsed
+    incrementally and the elements are cleared once read,
+    so the whole tree is never built.
+    
+    Parameters
+    ----------
+    source : file object
+        the BioCyc XML, opened in binary mode
+    path : str
+        'parent/child' tags, matched at any depth, e.g.
+        'in-pathway/Pathway' for ".//in-pathway/Pathway"
+    
+    Returns
+    -------
+    frameIds : list
+        the frame ids of the matching elements
+    """
+    parentTag, childTag = path.split('/')
+    frameIds = []
+    openTags = []
+    for event, e in ET.iterparse(source, events = ('start', 'end')):
+        if event == 'start':
+            if e.tag == childTag and openTags and openTags[-1] == parentTag:
+                frameIds.append(e.attrib['frameid'])
+            openTags.append(e.tag)
+        else:
+            openTags.pop()
+            e.clear()
+    return frameIds
+
+def parseBiocyc(ID, parse):
+    """
+    Performs a request for an object (reaction, pathway ...)
+    with its ID in BioCyc and parses the response. The
+    response cache is read first, and the downloaded
+    responses are stored in it once parsed.
+    
+    Parameters
+    ----------
+    ID : string
+        the id of the requested object
+    parse : function
+        called with the BioCyc XML as a binary file object
+    
+    Returns
+    -------
+    the result of parse
+
+    Raises
+    ------
+    BiocycNotFoundError
+        if the object is not found on BioCyc
+    """
+    cached = None
+    if responseCache is not None:
+        cached = responseCache.get(organism, ID)
+    if cached is None:
+        status, content = downloadBiocyc(ID)
+    else:
+        status, content = cached
+    if status == 404:
+        result = None
+    else:
+        try:
+            result = parse(io.BytesIO(content))
+        # a truncated response must not be cached
+        except ET.ParseError as e:
+            raise TransientError(f"{ID}: invalid XML ({e})") from e
+    # only keep definitive answers
+    if cached is None and responseCache is not None:
+        responseCache.put(organism, ID, status, content)
+    if status == 404:
+        raise BiocycNotFoundError(f"{ID} not found on BioCyc")
+    return result
+
 def requestBiocyc(ID):
     """
     Performs a request for an object (reaction, pathway ...)
@@ -29,69 +217,55 @@ def requestBiocyc(ID):
     doc : ElementTree.Element
         The BioCyc XML text of our requested object 
     """
-    # monitor requests 
-    URL = "https://websvc.biocyc.org/getxml?ECOLI:" + ID
-    response = requests.get(URL, timeout = 5)
-    print(f"{round(time.time() - start, 2)}: {ID} ({response.status_code})")
-    if response.status_code == 200:
-        doc = ET.fromstring(response.text)
-    # in case of a temporary ban
-    elif response.status_code == 429:
-        time.sleep(60)
-        doc = requestBiocyc(ID)
+    doc = parseBiocyc(ID, lambda source: ET.parse(source).getroot())
     return doc
 
-def getPathwaysID(pathways, reaction):
+def requestBiocycFrameIds(ID, path):
     """
-    Adds the metabolic pathways associated with the reaction
-    to the list of pathways. 
+    Performs a request for an object (reaction, pathway ...)
+    with its ID in BioCyc, and only extracts the frame ids
+    matching a path with extractFrameIds().
     
     Parameters
     ----------
-    pathways: list
-        the list of pathways associated to our reactions 
-        in BioCyc
-    reaction: string
-        the id of the reaction for which we search its
-        pathways in BioCyc
+    ID : string
+        the id of the requested object
+    path : str
+        'parent/child' tags, e.g. 'in-pathway/Pathway'
+    
+    Returns
+    -------
+    frameIds : list
     """
-    doc = requestBiocyc(reaction)
-    for e in doc.findall(".//in-pathway/Pathway"):
-        ID = e.attrib['frameid']
-        if ID not in pathways:
-            pathways.append(ID)
-    return pathways
-   
-def getPathways(reactions):
+    frameIds = parseBiocyc(ID, lambda source: extractFrameIds(source, path))
+    return frameIds
+
+def getReactionPathwayIds(reaction, doc = None):
     """
-    Gets the list of pathways associated to reactions in
-    Biocyc and the list of reactions to delete not found 
-    in BioCyc.
+    Retrieves in BioCyc all pathways associated to a reaction.
     
     Parameters
     ----------
-    reactions: lists
-        the list of reaction IDs retrieved from our Tulip
-        graph
-                          
+    reaction: string
+        the id of the reaction for which we search its
+        pathways in BioCyc
+    doc: ElementTree.Element
+        the parsed BioCyc XML of the reaction. If None, the
+        pathways are streamed from the requested XML
+    
     Returns
     -------
-    pathways: list
-        the list of pathways associated to our reactions
-        in BioCyc
-    to_delete: list
-        the list of reactions to delete in our Tulip graph
+    pathways : list
+        the list of associated pathways ids
     """
+    if doc is None:
+        return requestBiocycFrameIds(reaction, 'in-pathway/Pathway')
     pathways = []
-    to_delete = []
-    for r in reactions:
-        try:
-            pathways = getPathwaysID(pathways, r)
-        except :
-            to_delete.append(r)
-    return pathways, to_delete
+    for e in doc.findall(".//in-pathway/Pathway"):
+        pathways.append(e.attrib['frameid'])
+    return pathways
 
-def getReactionIdsFromPathway(pathway):
+def getReactionIdsFromPathway(pathway, doc = None):
     """
     Retrieves in BioCyc all reactions associated to a pathway.
     
@@ -99,42 +273,161 @@ def getReactionIdsFromPathway(pathway):
     ----------
     pathway : str
         the pathway id
+    doc : ElementTree.Element
+        the parsed BioCyc XML of the pathway. If None, the
+        reactions are streamed from the requested XML
         
     Returns
     -------
     reactions : list
         the list of associated reactions ids
     """
+    if doc is None:
+        return requestBiocycFrameIds(pathway, 'reaction-list/Reaction')
     reactions = []
-    doc = requestBiocyc(pathway)
     for e in doc.findall(".//reaction-list/Reaction"):
         reactions.append(e.attrib['frameid'])
     return reactions
 
-def getPathwayIdsToReactions(pathways):
+class PathwayIndex:
     """
-    Associate for each identified metabolic pathway the 
-    reactions that are associated with it.
+    Bidirectional index between reactions and pathways.
+    Both mappings are built together from the reaction
+    documents, and each frame id is fetched at most once.
+    The sets are insertion-ordered dicts with None values.
     
     Parameters
     ----------
-    pathways: list
-        the list of identified pathways
-    
-    Returns
-    -------
-    data: dict
-        string of pathway id as key and its associated
-        reaction list as values
-    """
-    data = {}
-    for p in pathways:
-        try :
-            reactions_list = getReactionIdsFromPathway(p)
-            data[p] = reactions_list
-        except :
-            pass
-    return data
+    getReactionPathways : function
+        called with a reaction id, returns its pathways ids
+    getPathwayReactions : function
+        called with a pathway id, returns its reactions ids
+    fetchPathways : bool
+        if True, the pathway documents are also fetched to
+        add the reactions absent from the reaction documents.
+        If False, pathways only map to the indexed reactions,
+        which halves the number of requests
+    concurrent : bool
+        if True, the ids are fetched with fetchAll()
+    """
+
+    def __init__(self, getReactionPathways = getReactionPathwayIds,
+                 getPathwayReactions = getReactionIdsFromPathway,
+                 fetchPathways = False, concurrent = True):
+        self.getReactionPathways = getReactionPathways
+        self.getPathwayReactions = getPathwayReactions
+        self.fetchPathways = fetchPathways
+        self.concurrent = concurrent
+        self.reactionToPathways = {}
+        self.pathwayToReactions = {}
+        self.notFound = {}
+        self.fetchedPathways = set()
+        self.stats = FetchStats()
+
+    def fetch(self, IDs, lookup):
+        """
+        Apply a lookup function to each id.
+        
+        Parameters
+        ----------
+        IDs : list
+        lookup : function
+        
+        Returns
+        -------
+        results : dict
+            id as key and lookup result as value
+        errors : dict
+            id as key and raised exception as value
+        """
+        if self.concurrent:
+            return fetchAll(IDs, lookup,
+                            maxWorkers = maxConcurrentRequests,
+                            rate = maxRequestRate, stats = self.stats)
+        results, errors = {}, {}
+        for ID in IDs:
+            try:
+                results[ID] = lookup(ID)
+            except Exception as e:
+                errors[ID] = e
+        return results, errors
+
+    def addReactions(self, reactions):
+        """
+        Index reactions and their pathways. Reactions already
+        indexed are not fetched again.
+        
+        Parameters
+        ----------
+        reactions : list
+            the list of reactions ids
+        """
+        newReactions = [r for r in dict.fromkeys(reactions)
+                        if r not in self.reactionToPathways
+                        and r not in self.notFound]
+        results, errors = self.fetch(newReactions, self.getReactionPathways)
+        for r in newReactions:
+            if r in results:
+                pathways = dict.fromkeys(results[r])
+                self.reactionToPathways[r] = pathways
+                for p in pathways:
+                    self.pathwayToReactions.setdefault(p, {})[r] = None
+            # a timeout or a cache miss does not mean that the
+            # reaction does not exist
+            elif isinstance(errors[r], BiocycNotFoundError):
+                self.notFound[r] = None
+            else:
+                print(f"{r} kept, request failed: {errors[r]!r}")
+        if self.fetchPathways:
+            self.addPathwayReactions(list(self.pathwayToReactions))
+
+    def addPathwayReactions(self, pathways):
+        """
+        Complete pathways with the reactions listed in their
+        documents. Pathways already fetched are skipped.
+        
+        Parameters
+        ----------
+        pathways : list
+            the list of pathways ids
+        """
+        newPathways = [p for p in pathways if p not in self.fetchedPathways]
+        results, errors = self.fetch(newPathways, self.getPathwayReactions)
+        for p, reactions in results.items():
+            self.fetchedPathways.add(p)
+            pathwayReactions = self.pathwayToReactions.setdefault(p, {})
+            pathwayReactions.update(dict.fromkeys(reactions))
+
+    def getPathwayIds(self):
+        """
+        Returns
+        -------
+        list
+            the indexed pathways, in order of discovery
+        """
+        return list(self.pathwayToReactions)
+
+    def getNotFoundReactions(self):
+        """
+        Returns
+        -------
+        list
+            the reactions not found on BioCyc
+        """
+        return list(self.notFound)
+
+    def getPathwayIdsToReactions(self):
+        """
+        Returns
+        -------
+        data : dict
+            pathway id as key and the list of its reactions
+            ids as value
+        """
+        data = {}
+        for p, reactions in self.pathwayToReactions.items():
+            data[p] = list(reactions)
+        return data
 
 def getNodeIdsFromGraph(graph, targetReaction):
     """
@@ -189,7 +482,7 @@ def removeNotBiocycReactions(graph, notBR):
                                                 nodeIdsToKeep,
                                                 excluded = True))
 
-def filterBiocycPathways(graph):
+def filterBiocycPathways(graph, fetchPathways = False, offlineBiocyc = None):
     """
     Removes the reactions not found on BioCyc and returns
     a dict of pathways as keys and their reactions as values.
@@ -198,6 +491,12 @@ def filterBiocycPathways(graph):
     ----------
     graph: tlp.Graph
         the Ecoli K12 substrates - reactions graph 
+    fetchPathways: bool
+        if True, the pathways documents are also fetched
+        to list their reactions absent from the graph
+    offlineBiocyc: handle_offline.OfflineBiocyc
+        if given, BioCyc is queried from this local store
+        instead of the web service
         
     Returns
     -------
@@ -210,9 +509,19 @@ def filterBiocycPathways(graph):
     start = time.time()
     reactions = getNodeIdsFromGraph(graph,
                                     targetReaction = True)
-    pathways, reactions_to_del = getPathways(reactions)
-    data = getPathwayIdsToReactions(pathways)
+    if offlineBiocyc is None:
+        index = PathwayIndex(fetchPathways = fetchPathways)
+    else:
+        index = PathwayIndex(offlineBiocyc.getReactionPathwayIds,
+                             offlineBiocyc.getReactionIdsFromPathway,
+                             fetchPathways = fetchPathways,
+                             concurrent = False)
+    index.addReactions(reactions)
+    reactions_to_del = index.getNotFoundReactions()
+    data = index.getPathwayIdsToReactions()
     removeNotBiocycReactions(graph, reactions_to_del)
     print(f"""{len(reactions_to_del)} reactions not
           found on BioCyc and deleted.""")
+    if responseCache is not None:
+        print(f"BioCyc cache: {responseCache.getStats()}")
     return data
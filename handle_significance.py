@@ -0,0 +1,299 @@
+"""
+This library is dedicated to the significance of pathway
+scores, estimated with gene-label permutations. Each batch of
+permutations is scored at once over the reaction x gene and
+pathway x reaction incidences.
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import handle_genes
+import handle_parallel
+from handle_parallel import SharedMatrix, initWorker
+from handle_reactions import getReactionGeneMatrix
+from aggregate_data import getSegmentAggregate
+
+nPermutations = 1000
+permutationSeed = 0
+# permutations scored at once : bounds the memory to about
+# batchSize x genes of the pathways x timestamps values
+permutationBatchSize = 50
+
+def getPermutationModel(pathwayIdToReactions, reactionIdToGenes, dataset = None):
+    """
+    Return the incidences scored by the permutations : the
+    distinct gene sets of the reactions, and the gene sets of
+    each pathway. Substrates, products, and reactions without
+    measured genes are left out, as they have no expression.
+
+    Parameters
+    ----------
+    pathwayIdToReactions: dict
+        pathwayId as key and reactions as values
+    reactionIdToGenes: dict
+        reactionId as key and measured genes as values
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+
+    Returns
+    -------
+    model: dict
+        'pathwayIds', the 'geneSetOffsets' and 'geneSetRows'
+        (dataset rows) of the gene sets, the 'pathwayOffsets'
+        and 'pathwayMembers' (gene sets) of the pathways
+    """
+    dataset = dataset or handle_genes.dataset
+    setIndex, geneSets = {}, []
+    pathwayMembers, pathwayOffsets = [], [0]
+    for pathwayId, reactions in pathwayIdToReactions.items():
+        for reactionId in reactions:
+            genes = reactionIdToGenes.get(reactionId, [])
+            if len(genes) == 0:
+                continue
+            key = frozenset(genes)
+            if key not in setIndex:
+                setIndex[key] = len(geneSets)
+                geneSets.append(genes)
+            pathwayMembers.append(setIndex[key])
+        pathwayOffsets.append(len(pathwayMembers))
+    incidence = getReactionGeneMatrix(range(len(geneSets)), geneSets, dataset)
+    model = {'pathwayIds': list(pathwayIdToReactions),
+             'geneSetOffsets': incidence.indptr,
+             'geneSetRows': incidence.indices,
+             'pathwayOffsets': np.array(pathwayOffsets),
+             'pathwayMembers': np.array(pathwayMembers, dtype = int)}
+    return model
+
+def getBatchedSegmentAggregate(values, offsets, method, nTimestamps):
+    """
+    Aggregate segments of rows holding a batch of
+    permutations side by side, nTimestamps columns each.
+
+    Parameters
+    ----------
+    values : numpy array
+        members x (permutations x timestamps)
+    offsets : numpy array
+    method : str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    nTimestamps : int
+
+    Returns
+    -------
+    numpy array
+        segments x (permutations x timestamps)
+    """
+    # these methods aggregate each column on its own
+    if method in ['mean', 'upDownZ']:
+        return getSegmentAggregate(values, offsets, method)
+    # the others depend on whole rows : one call per permutation
+    blocks = [getSegmentAggregate(values[:, start:start + nTimestamps], offsets, method)
+              for start in range(0, values.shape[1], nTimestamps)]
+    return np.hstack(blocks)
+
+def getPermutedPathwayScores(matrix, permutations, model, reactionMethod, pathwayMethod):
+    """
+    Score the pathways for a batch of gene-label permutations.
+
+    Parameters
+    ----------
+    matrix : numpy array
+        the dataset levels (normalZ) or ratios
+    permutations : numpy array
+        permutations x dataset rows, the row of each gene
+        takes the values of the row given by the permutation
+    model : dict
+        see getPermutationModel()
+    reactionMethod : str
+    pathwayMethod : str
+
+    Returns
+    -------
+    numpy array
+        pathways x permutations x timestamps
+    """
+    nPermutations, nTimestamps = len(permutations), matrix.shape[1]
+    rows = permutations[:, model['geneSetRows']]
+    # permutations side by side : members x (permutations x timestamps)
+    values = matrix[rows].transpose(1, 0, 2).reshape(rows.shape[1], -1)
+    reactionScores = getBatchedSegmentAggregate(values, model['geneSetOffsets'],
+                                                reactionMethod, nTimestamps)
+    pathwayScores = getBatchedSegmentAggregate(reactionScores[model['pathwayMembers']],
+                                               model['pathwayOffsets'], pathwayMethod,
+                                               nTimestamps)
+    return pathwayScores.reshape(len(pathwayScores), nPermutations, nTimestamps)
+
+def countExceedances(observed, nullScores):
+    """
+    Count the permutation scores at least as extreme as the
+    observed scores (two-sided).
+
+    Parameters
+    ----------
+    observed : numpy array
+        pathways x timestamps
+    nullScores : numpy array
+        pathways x permutations x timestamps
+
+    Returns
+    -------
+    nExceed : numpy array
+        pathways x timestamps
+    nValid : numpy array
+        pathways x timestamps, the permutations with a score
+    """
+    isValid = ~np.isnan(nullScores)
+    with np.errstate(invalid = 'ignore'):
+        isExceeding = np.abs(nullScores) >= np.abs(observed)[:, None, :]
+    return (isExceeding & isValid).sum(axis = 1), isValid.sum(axis = 1)
+
+def runPermutationBatch(seed, batchSize, model, observed, reactionMethod,
+                        pathwayMethod, matrix = None):
+    """
+    Score a batch of random permutations against the observed
+    scores.
+
+    Parameters
+    ----------
+    seed : numpy.random.SeedSequence
+        the seed of this batch
+    batchSize : int
+    model : dict
+    observed : numpy array
+        pathways x timestamps
+    reactionMethod : str
+    pathwayMethod : str
+    matrix : numpy array
+        the shared matrix of the worker process if None
+
+    Returns
+    -------
+    nExceed : numpy array
+    nValid : numpy array
+    """
+    if matrix is None:
+        matrix = handle_parallel.workerMatrix
+    rng = np.random.default_rng(seed)
+    identity = np.tile(np.arange(len(matrix)), (batchSize, 1))
+    permutations = rng.permuted(identity, axis = 1)
+    nullScores = getPermutedPathwayScores(matrix, permutations, model,
+                                          reactionMethod, pathwayMethod)
+    return countExceedances(observed, nullScores)
+
+def runWorkerPermutationBatch(seed, batchSize):
+    """
+    runPermutationBatch() in a worker process, with the data
+    given to handle_parallel.initWorker().
+    """
+    return runPermutationBatch(seed, batchSize, *handle_parallel.workerState)
+
+def getBenjaminiHochberg(pValues):
+    """
+    Return the Benjamini-Hochberg adjusted p-values (FDR) of
+    each column, ignoring NaN.
+
+    Parameters
+    ----------
+    pValues : numpy array
+        tests x families
+
+    Returns
+    -------
+    numpy array
+    """
+    fdr = np.full(pValues.shape, np.nan)
+    for j in range(pValues.shape[1]):
+        isTested = ~np.isnan(pValues[:, j])
+        p = pValues[isTested, j]
+        order = np.argsort(p)
+        ranked = p[order] * len(p) / np.arange(1, len(p) + 1)
+        # the adjusted p-values are monotonic in the p-values
+        adjusted = np.minimum(1, np.minimum.accumulate(ranked[::-1])[::-1])
+        column = np.empty(len(p))
+        column[order] = adjusted
+        fdr[isTested, j] = column
+    return fdr
+
+def getPathwaySignificance(pathwayIdToReactions, reactionIdToGenes, reactionMethod,
+                           pathwayMethod, dataset = None, permutations = None,
+                           seed = None, batchSize = None, processes = 1):
+    """
+    Estimate the significance of the pathway scores with
+    gene-label permutations : the genes of the dataset are
+    shuffled, and the reactions and pathways scored again.
+    Same seed, same results, whatever the number of processes.
+
+    Parameters
+    ----------
+    pathwayIdToReactions: dict
+        pathwayId as key and reactions as values
+    reactionIdToGenes: dict
+        reactionId as key and measured genes as values
+    reactionMethod: str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ']
+    pathwayMethod: str
+        from ['mean', 'maxStd', 'minStd', 'upDownZ']
+    dataset: handle_genes.ExpressionDataset
+        the default dataset if None
+    permutations: int
+        nPermutations if None
+    seed: int
+        permutationSeed if None
+    batchSize: int
+        permutationBatchSize if None
+    processes: int
+        the number of processes scoring the batches,
+        all the CPUs if None
+
+    Returns
+    -------
+    significance: dict
+        'score', 'pValue' (empirical, two-sided) and 'fdr'
+        (Benjamini-Hochberg over the pathways of each
+        timestamp) pandas.DataFrame, pathways x timestamps
+    """
+    dataset = dataset or handle_genes.dataset
+    permutations = permutations or nPermutations
+    seed = permutationSeed if seed is None else seed
+    batchSize = batchSize or permutationBatchSize
+    matrix = dataset.levels if reactionMethod == 'normalZ' else dataset.ratios
+    model = getPermutationModel(pathwayIdToReactions, reactionIdToGenes, dataset)
+    identity = np.arange(len(matrix))[None, :]
+    observed = getPermutedPathwayScores(matrix, identity, model,
+                                        reactionMethod, pathwayMethod)[:, 0]
+    sizes = [min(batchSize, permutations - start) for start in range(0, permutations, batchSize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    state = (model, observed, reactionMethod, pathwayMethod)
+    if processes == 1:
+        counts = [runPermutationBatch(s, size, *state, matrix = matrix)
+                  for s, size in zip(seeds, sizes)]
+    else:
+        sharedMatrix = SharedMatrix(matrix)
+        try:
+            with ProcessPoolExecutor(max_workers = processes or os.cpu_count(),
+                                     initializer = initWorker,
+                                     initargs = (sharedMatrix.descriptor, state)) as executor:
+                counts = list(executor.map(runWorkerPermutationBatch, seeds, sizes))
+        finally:
+            sharedMatrix.close()
+    nExceed = sum(c[0] for c in counts)
+    nValid = sum(c[1] for c in counts)
+    with np.errstate(invalid = 'ignore'):
+        pValues = (1 + nExceed) / (1 + nValid)
+    pValues[np.isnan(observed)] = np.nan
+    columns = [f'tp {t+1}' for t in range(matrix.shape[1])]
+    significance = {}
+    for name, values in [('score', observed), ('pValue', pValues),
+                         ('fdr', getBenjaminiHochberg(pValues))]:
+        significance[name] = pd.DataFrame(values, index = model['pathwayIds'],
+                                          columns = columns)
+    return significance
@@ -9,38 +9,202 @@ Main script to run to complete the Tulip project.
 @ SIMON Arnaud
 """
 
-from handle_requests import filterBiocycPathways
+import numpy as np
+from handle_requests import filterBiocycPathways, setResponseCache
+from handle_cache import ResponseCache
+from handle_offline import OfflineBiocyc
 from handle_graphs import getWorkingGraph, renameLabelsWithProperty
 from handle_genes import loadGeneFiles
-from handle_reactions import parseGeneAssociation, setReactionExpressionProperty
-from handle_pathways import drawPathwaySubGraphs, drawQuotientGraphs, getAllPathwaysExpression
+from handle_reactions import (ReactionExpressionUpdater, filterGeneAssociation,
+                              getAssociatedGenes, getGeneAssociation,
+                              setReactionExpressionProperty, updateReactionExpressionProperty)
+from handle_pathways import (PathwayExpressionUpdater, PathwayRegistry, addTimestamps,
+                             drawQuotientGraph, getAllPathwaysExpressionFromReactions,
+                             showTimestamp)
 from handle_heatmap import getHeatmap, convertToDataFrame
+from handle_significance import getPathwaySignificance
 
-nTimestamps = 17
 reactionExpressionMethod = 'normalZ' # options: 'mean', 'maxStd', 'minStd', 'upDownZ', 'normalZ'
 pathwayExpressionMethod = 'upDownZ' # options: 'mean', 'maxStd', 'minStd', 'upDownZ'
+biocycCacheFilename = 'biocycCache.sqlite'
+biocycCacheTTL = 30 * 24 * 3600 # seconds
+biocycCacheMaxSize = 500 * 2**20 # bytes
+biocycCacheOnly = False # if True, never query BioCyc
+biocycOfflineStore = None # store built with handle_offline.buildOfflineStore()
+reactionProcesses = 1 # processes scoring the reactions, None for all the CPUs
+pathwayPermutations = 0 # gene-label permutations testing the pathway scores, 0 to skip
+significanceThreshold = 0.05 # FDR
+maxPathwaySubGraphs = 20 # pathway subgraphs kept open, None for no limit
 
-def main(graph):
-    
+# the pathways of the last run : select nodes of the quotient
+# graph, then open them with pathwayRegistry.openSelectedPathways()
+pathwayRegistry = None
+# the significance of the pathway scores of the last run, if
+# tested : 'score', 'pValue', 'fdr' and 'significant' (fdr
+# below significanceThreshold) pathways x timestamps tables
+pathwaySignificance = None
+
+def prepareGraph(graph):
+    """
+    Get the working graph, query BioCyc to get pathways and
+    remove nodes without pathways. It does not depend on the
+    expression dataset.
+
+    Parameters
+    ----------
+    graph: tlp.Graph
+
+    Returns
+    -------
+    wg: tlp.Graph
+        the working graph
+    pathways: dict
+        pathwayId as key and reactions as values
+    """
     wg = getWorkingGraph(graph)
-    
-    # query BioCyc to get pathways and remove nodes without pathways
-    pathways = filterBiocycPathways(wg)
+    if biocycOfflineStore is None:
+        setResponseCache(ResponseCache(biocycCacheFilename, ttl = biocycCacheTTL,
+                                       maxSize = biocycCacheMaxSize,
+                                       cacheOnly = biocycCacheOnly))
+        pathways = filterBiocycPathways(wg)
+    else:
+        pathways = filterBiocycPathways(wg, offlineBiocyc = OfflineBiocyc(biocycOfflineStore))
     print(f"{len(pathways)} pathways found.")
-
-    loadGeneFiles()
     renameLabelsWithProperty(wg, 'id')
+    return wg, pathways
+
+def main(graph):
+    global pathwayRegistry, pathwaySignificance
+    wg, pathways = prepareGraph(graph)
+    # only load the expression of the genes of the graph
+    geneAssociation = getGeneAssociation(wg)
+    dataset = loadGeneFiles(geneNames = getAssociatedGenes(geneAssociation))
      
     # compute the expression score of reactions
-    reactionIdToGenes = parseGeneAssociation(wg)
-    setReactionExpressionProperty(wg, reactionIdToGenes, reactionExpressionMethod)    
-
-    # split the pathways into subgraphs
-    drawPathwaySubGraphs(wg, pathways)
-    pathwaysExpression = getAllPathwaysExpression(wg, pathwayExpressionMethod)
-    # draw quotient graphs for each timestamp
-    drawQuotientGraphs(wg, pathwaysExpression, timestamps=range(nTimestamps))
+    reactionIdToGenes = filterGeneAssociation(geneAssociation, dataset)
+    reactionIdToExpression = setReactionExpressionProperty(wg, reactionIdToGenes,
+                                                           reactionExpressionMethod, dataset,
+                                                           reactionProcesses)
+    pathwaysExpression = getAllPathwaysExpressionFromReactions(pathways, reactionIdToExpression,
+                                                               pathwayExpressionMethod)
+    nTimestamps = dataset.getTimestampCount()
+    pathwaySignificance = None
+    if pathwayPermutations > 0:
+        pathwaySignificance = getPathwaySignificance(pathways, reactionIdToGenes,
+                                                     reactionExpressionMethod,
+                                                     pathwayExpressionMethod, dataset,
+                                                     pathwayPermutations,
+                                                     processes = reactionProcesses)
+        pathwaySignificance['significant'] = pathwaySignificance['fdr'] < significanceThreshold
+
+    # the pathway subgraphs are only created when opened
+    pathwayRegistry = PathwayRegistry(wg, pathways, maxPathwaySubGraphs)
+    # draw the quotient graph, with the expression of each timestamp
+    drawQuotientGraph(wg, pathwaysExpression, timestamps=range(nTimestamps),
+                      pathwayRegistry=pathwayRegistry)
     
     # draw the heatmap
     pathwaysExpressionDataFrame = convertToDataFrame(pathwaysExpression, nTimestamps)
     getHeatmap(pathwaysExpressionDataFrame, clusterize=True)
+
+def runBatch(graph, datasets):
+    """
+    Score many expression datasets against the same graph.
+    BioCyc is queried once.
+
+    Parameters
+    ----------
+    graph: tlp.Graph
+    datasets: list
+        the handle_genes.ExpressionDataset to score, see
+        handle_genes.loadExpressionDataset()
+
+    Returns
+    -------
+    datasetToPathwaysExpression: dict
+        dataset name as key and the pathways expression
+        dict as value
+    """
+    wg, pathways = prepareGraph(graph)
+    geneAssociation = getGeneAssociation(wg)
+    datasetToPathwaysExpression = {}
+    for dataset in datasets:
+        reactionIdToGenes = filterGeneAssociation(geneAssociation, dataset)
+        reactionIdToExpression = setReactionExpressionProperty(wg, reactionIdToGenes,
+                                                               reactionExpressionMethod, dataset,
+                                                               reactionProcesses)
+        pathwaysExpression = getAllPathwaysExpressionFromReactions(pathways, reactionIdToExpression,
+                                                                   pathwayExpressionMethod)
+        datasetToPathwaysExpression[dataset.name] = pathwaysExpression
+    return datasetToPathwaysExpression
+
+def startTimeCourse(graph):
+    """
+    Same as main(), keeping the running aggregates of reactions
+    and pathways so that timestamps measured later can be added
+    with appendTimestamps().
+
+    Parameters
+    ----------
+    graph: tlp.Graph
+
+    Returns
+    -------
+    timeCourse: dict
+        the working graph, the dataset, the pathway registry
+        and the reactions and pathways updaters
+    """
+    wg, pathways = prepareGraph(graph)
+    geneAssociation = getGeneAssociation(wg)
+    dataset = loadGeneFiles(geneNames = getAssociatedGenes(geneAssociation))
+    reactionIdToGenes = filterGeneAssociation(geneAssociation, dataset)
+    reactionIds = [wg['id'][n] for n in wg.getNodes()]
+    reactionUpdater = ReactionExpressionUpdater(reactionIds, reactionIdToGenes,
+                                                reactionExpressionMethod, dataset)
+    changed = np.ones(len(reactionUpdater.reactionIds), dtype = bool)
+    updateReactionExpressionProperty(wg, reactionUpdater, changed, 0)
+    registry = PathwayRegistry(wg, pathways, maxPathwaySubGraphs)
+    pathwayUpdater = PathwayExpressionUpdater(pathways, reactionUpdater, pathwayExpressionMethod)
+    pathwaysExpression = pathwayUpdater.getPathwaysExpression()
+    nTimestamps = dataset.getTimestampCount()
+    qg = drawQuotientGraph(wg, pathwaysExpression, timestamps = range(nTimestamps),
+                           pathwayRegistry = registry)
+    getHeatmap(convertToDataFrame(pathwaysExpression, nTimestamps), clusterize = True)
+    return {'graph': wg, 'dataset': dataset, 'quotientGraph': qg, 'registry': registry,
+            'reactions': reactionUpdater, 'pathways': pathwayUpdater}
+
+def appendTimestamps(timeCourse, levels, ratios):
+    """
+    Add timestamps to a time course started with
+    startTimeCourse(). Only the new timestamps are aggregated,
+    pushed into the reactions expression and added to the
+    quotient graph, whose layout is kept ; the earlier
+    timestamps are refreshed when pathways changed
+    (min/max-std reaction, normalZ). The last timestamp is
+    displayed.
+
+    Parameters
+    ----------
+    timeCourse: dict
+        returned by startTimeCourse()
+    levels: numpy array
+        expression levels, one row per locus of the dataset,
+        one column per new timestamp
+    ratios: numpy array
+        differential expressions, as levels
+    """
+    wg = timeCourse['graph']
+    reactionUpdater, pathwayUpdater = timeCourse['reactions'], timeCourse['pathways']
+    nPrevious = reactionUpdater.getTimestampCount()
+    timeCourse['dataset'].appendTimepoints(levels, ratios)
+    changedReactions = reactionUpdater.update()
+    updateReactionExpressionProperty(wg, reactionUpdater, changedReactions, nPrevious)
+    changedPathways = pathwayUpdater.update(changedReactions)
+    pathwaysExpression = pathwayUpdater.getPathwaysExpression()
+    nTimestamps = reactionUpdater.getTimestampCount()
+    qg = timeCourse['quotientGraph']
+    firstTimestamp = 0 if changedPathways.any() else nPrevious
+    addTimestamps(qg, pathwaysExpression, range(firstTimestamp, nTimestamps))
+    showTimestamp(qg, nTimestamps - 1)
+    # the rows are clusterized again on all the timestamps
+    getHeatmap(convertToDataFrame(pathwaysExpression, nTimestamps), clusterize = True)
@@ -0,0 +1,243 @@
+"""
+This library is dedicated to a local stand-in for the BioCyc
+web service, used to test and benchmark the fetch layer.
+Point handle_requests.biocycURL to StubBiocycServer.url.
+
+@ ASLOUDJ Yanis
+@ COLAJANNI Antonin
+@ DUGUE Berenice
+@ JACQUES Patrick
+@ SAUVESTRE Clement
+@ SIMON Arnaud
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+def getReactionXML(reaction, pathways):
+    """
+    Return a minimal getxml document of a reaction.
+
+    Parameters
+    ----------
+    reaction: str
+    pathways: list
+
+    Returns
+    -------
+    bytes
+    """
+    links = ''.join(f'<Pathway frameid="{p}" orgid="ECOLI"/>' for p in pathways)
+    return (f'<ptools-xml><metadata/><Reaction frameid="{reaction}" orgid="ECOLI">'
+            f'<in-pathway>{links}</in-pathway></Reaction></ptools-xml>').encode()
+
+def getPathwayXML(pathway, reactions):
+    """
+    Return a minimal getxml document of a pathway.
+
+    Parameters
+    ----------
+    pathway: str
+    reactions: list
+
+    Returns
+    -------
+    bytes
+    """
+    links = ''.join(f'<Reaction frameid="{r}" orgid="ECOLI"/>' for r in reactions)
+    return (f'<ptools-xml><metadata/><Pathway frameid="{pathway}" orgid="ECOLI">'
+            f'<reaction-list>{links}</reaction-list></Pathway></ptools-xml>').encode()
+
+def makeDocuments(nReactions, nPathways, pathwaysPerReaction = 2, seed = 0):
+    """
+    Generate a synthetic set of reaction and pathway documents.
+
+    Parameters
+    ----------
+    nReactions: int
+    nPathways: int
+    pathwaysPerReaction: int
+    seed: int
+
+    Returns
+    -------
+    documents: dict
+        frame id as key and getxml document (bytes) as value
+    """
+    rng = random.Random(seed)
+    pathwayIds = [f'PWY-{p}' for p in range(nPathways)]
+    pathwayToReactions = {p: [] for p in pathwayIds}
+    documents = {}
+    for r in range(nReactions):
+        reaction = f'RXN-{r}'
+        pathways = rng.sample(pathwayIds, min(pathwaysPerReaction, nPathways))
+        for p in pathways:
+            pathwayToReactions[p].append(reaction)
+        documents[reaction] = getReactionXML(reaction, pathways)
+    for p, reactions in pathwayToReactions.items():
+        documents[p] = getPathwayXML(p, reactions)
+    return documents
+
+def loadDocuments(directory):
+    """
+    Load canned getxml documents saved as <frame id>.xml.
+
+    Parameters
+    ----------
+    directory: str
+
+    Returns
+    -------
+    documents: dict
+        frame id as key and getxml document (bytes) as value
+    """
+    documents = {}
+    for filename in os.listdir(directory):
+        frameId, extension = os.path.splitext(filename)
+        if extension == '.xml':
+            with open(os.path.join(directory, filename), 'rb') as f:
+                documents[frameId] = f.read()
+    return documents
+
+class StubBiocycHandler(BaseHTTPRequestHandler):
+    """
+    Serves GET /getxml?ORGANISM:ID from the server documents,
+    with the faults configured on the server.
+    """
+
+    def do_GET(self):
+        server = self.server
+        path, separator, query = self.path.partition('?')
+        frameId = unquote(query).partition(':')[2]
+        fault = server.drawFault()
+        server.count(fault)
+        if server.latency > 0:
+            time.sleep(server.rng.expovariate(1 / server.latency))
+        if fault == 'timeout':
+            time.sleep(server.timeoutDelay)
+        if fault == 'throttled':
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+        if fault == 'error':
+            self.send_error(500)
+            return
+        if path != '/getxml' or frameId not in server.documents:
+            self.send_error(404)
+            return
+        body = server.documents[frameId]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubBiocycServer(ThreadingHTTPServer):
+    """
+    Local HTTP server standing in for websvc.biocyc.org.
+
+    Parameters
+    ----------
+    documents: dict
+        frame id as key and getxml document (bytes) as value
+    latency: float
+        the mean latency of a response in seconds
+        (exponentially distributed)
+    throttleRate: float
+        the probability of a 429 response
+    errorRate: float
+        the probability of a 500 response
+    timeoutRate: float
+        the probability of answering after timeoutDelay
+    timeoutDelay: float
+        in seconds, longer than the client timeout
+    port: int
+        0 to pick a free port
+    seed: int
+    """
+
+    daemon_threads = True
+
+    def __init__(self, documents, latency = 0.0, throttleRate = 0.0,
+                 errorRate = 0.0, timeoutRate = 0.0, timeoutDelay = 10.0,
+                 port = 0, seed = 0):
+        super().__init__(('127.0.0.1', port), StubBiocycHandler)
+        self.documents = documents
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.errorRate = errorRate
+        self.timeoutRate = timeoutRate
+        self.timeoutDelay = timeoutDelay
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'throttled': 0,
+                       'error': 0, 'timeout': 0}
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        The base URL to use as handle_requests.biocycURL.
+        """
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def drawFault(self):
+        """
+        Draw the fault injected in a response.
+
+        Returns
+        -------
+        str
+            'throttled', 'error', 'timeout' or None
+        """
+        with self.lock:
+            draw = self.rng.random()
+        for fault, rate in [('throttled', self.throttleRate),
+                            ('error', self.errorRate),
+                            ('timeout', self.timeoutRate)]:
+            if draw < rate:
+                return fault
+            draw -= rate
+        return None
+
+    def count(self, fault):
+        """
+        Update the request counters.
+
+        Parameters
+        ----------
+        fault: str
+        """
+        with self.lock:
+            self.counts['requests'] += 1
+            if fault is not None:
+                self.counts[fault] += 1
+
+    def handle_error(self, request, client_address):
+        # clients hang up on injected timeouts
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        """
+        Serve in a background thread.
+        """
+        self.thread = threading.Thread(target = self.serve_forever,
+                                       daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving and close the socket.
+        """
+        self.shutdown()
+        self.server_close()